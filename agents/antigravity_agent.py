@@ -1,14 +1,26 @@
 import os
+from typing import Callable
 from google import genai
 from google.genai import types
 from .base_agent import BaseAgent
-from tools import run_command, read_file, write_file
+from context_budget import compact_gemini
+from tools import run_command as _run_command, read_file, write_file
 
 class AntiGravityAgent(BaseAgent):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, task_id: str = "", on_turn: Callable[[], bool] | None = None):
+        self.task_id = task_id  # 队列任务 id：run_command 按它推送输出、续约、取消
+        self.on_turn = on_turn  # 每轮开始时调用（记录进展）；返回 False 则停止
         self.client = genai.Client(api_key=api_key)
         self.model = "gemini-2.5-flash"
         self.history = []
+
+        # 绑定 task_id 的 run_command：工具声明里只暴露 command/timeout，
+        # 自动函数调用和下面的手动分发都经它执行，模型无法填写 task_id
+        def run_command(command: str, timeout: int | None = None) -> str:
+            """运行终端命令并返回其输出结果。用于执行脚本、测试、git、安装依赖等。timeout 为超时秒数（默认 60）。"""
+            return _run_command(command, timeout=timeout, task_id=task_id)
+
+        self.run_command = run_command
         self.tools = [run_command, read_file, write_file]
         
         system_instruction = (
@@ -28,6 +40,10 @@ class AntiGravityAgent(BaseAgent):
         try:
             # 简单的循环来自动处理最多 5 个连续的工具调用
             for _ in range(5):
+                if self.on_turn is not None and not self.on_turn():
+                    return "任务已取消。"
+                # 会话跨消息累积，超预算时省略旧工具结果、丢弃最早的对话
+                compact_gemini(self.history, drop_turns=True)
                 response = self.client.models.generate_content(
                     model=self.model,
                     contents=self.history,
@@ -44,7 +60,7 @@ class AntiGravityAgent(BaseAgent):
                         args = function_call.args
                         try:
                             if name == "run_command":
-                                result = run_command(**args)
+                                result = self.run_command(**args)
                             elif name == "read_file":
                                 result = read_file(**args)
                             elif name == "write_file":
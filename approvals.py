@@ -0,0 +1,170 @@
+"""
+放权通道：替代 .tg_response_<id>.txt 文件轮询
+
+请求方（MCP 服务器 / tg_ask）：create → 发按钮 → wait
+Bot 进程：用户点按钮 → resolve，写入数据库并通过 notify 立即唤醒请求方
+
+每个进程只有一个后台线程（ApprovalBroker）负责所有等待中的请求，
+请求以 Future 形式返回，同步调用 .result()，异步用 wait_async。
+过期请求由 broker 和 Bot 顺手清理。
+"""
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+import notify
+import task_queue
+
+logger = logging.getLogger(__name__)
+
+APPROVAL_CHANNEL = "approval"
+APPROVED = "APPROVED"
+REJECTED = "REJECTED"
+# 兜底检查间隔（唤醒数据报丢失时）
+FALLBACK_CHECK_SEC = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS approvals (
+    req_id     TEXT PRIMARY KEY,
+    verdict    TEXT,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+_schema_ready: set[str] = set()
+
+
+def _conn():
+    conn = task_queue.connect()
+    if task_queue.QUEUE_DB not in _schema_ready:
+        conn.executescript(_SCHEMA)
+        _schema_ready.add(task_queue.QUEUE_DB)
+    return conn
+
+
+def create(timeout_sec: float) -> str:
+    """登记一个待决的放权请求，返回 req_id"""
+    req_id = str(uuid.uuid4())[:8]
+    now = time.time()
+    _conn().execute(
+        "INSERT INTO approvals (req_id, verdict, created_at, expires_at) VALUES (?, NULL, ?, ?)",
+        (req_id, now, now + timeout_sec),
+    )
+    return req_id
+
+
+def resolve(req_id: str, approved: bool) -> bool:
+    """Bot 侧：记录用户的选择并唤醒请求方。请求不存在/已过期/已处理时返回 False"""
+    conn = _conn()
+    n = conn.execute(
+        "UPDATE approvals SET verdict = ? WHERE req_id = ? AND verdict IS NULL AND expires_at > ?",
+        (APPROVED if approved else REJECTED, req_id, time.time()),
+    ).rowcount
+    purge_expired()
+    if n:
+        notify.ring(APPROVAL_CHANNEL)
+    return bool(n)
+
+
+def cancel(req_id: str) -> None:
+    """撤销请求（发送失败、等待方放弃时）"""
+    try:
+        _conn().execute("DELETE FROM approvals WHERE req_id = ?", (req_id,))
+    except Exception as e:
+        logger.warning(f"撤销放权请求失败: {e}")
+
+
+def purge_expired() -> int:
+    """删除已过期的请求，返回删除数"""
+    return _conn().execute("DELETE FROM approvals WHERE expires_at <= ?", (time.time(),)).rowcount
+
+
+class ApprovalBroker:
+    """进程内单线程等待所有放权请求"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict[str, tuple[Future, float]] = {}
+        self._bell: notify.Doorbell | None = None
+        self._thread: threading.Thread | None = None
+
+    def submit(self, req_id: str, timeout_sec: float) -> Future:
+        """登记等待，返回 Future：结果 True=允许，False=拒绝或超时"""
+        fut: Future = Future()
+        with self._lock:
+            self._pending[req_id] = (fut, time.time() + timeout_sec)
+            if self._thread is None:
+                self._bell = notify.Doorbell(APPROVAL_CHANNEL)
+                self._thread = threading.Thread(target=self._run, name="approval-broker", daemon=True)
+                self._thread.start()
+            else:
+                self._bell.poke()
+        fut.add_done_callback(lambda f: self._discard(req_id, f))
+        return fut
+
+    def _discard(self, req_id: str, fut: Future) -> None:
+        """Future 被外部取消时撤销请求"""
+        if fut.cancelled():
+            with self._lock:
+                self._pending.pop(req_id, None)
+            cancel(req_id)
+
+    def _check(self) -> float:
+        """检查所有待决请求，返回下次需要醒来的秒数"""
+        with self._lock:
+            pending = dict(self._pending)
+        if not pending:
+            return FALLBACK_CHECK_SEC
+        ids = list(pending)
+        try:
+            rows = _conn().execute(
+                f"SELECT req_id, verdict FROM approvals WHERE req_id IN ({','.join('?' * len(ids))})", ids
+            ).fetchall()
+        except Exception as e:
+            logger.warning(f"查询放权结果失败: {e}")
+            return FALLBACK_CHECK_SEC
+        verdicts = dict(rows)
+        now = time.time()
+        next_wake = FALLBACK_CHECK_SEC
+        for req_id, (fut, deadline) in pending.items():
+            verdict = verdicts.get(req_id)
+            if verdict is None and now < deadline and req_id in verdicts:
+                next_wake = min(next_wake, deadline - now)
+                continue
+            with self._lock:
+                self._pending.pop(req_id, None)
+            cancel(req_id)
+            if verdict is None:
+                logger.warning(f"放权请求超时: {req_id}")
+            if not fut.done():
+                fut.set_result(verdict == APPROVED)
+        return max(next_wake, 0)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self._bell.wait(self._check())
+            except Exception as e:
+                logger.error(f"放权 broker 异常: {e}")
+                time.sleep(1)
+
+
+_broker = ApprovalBroker()
+
+
+def wait(req_id: str, timeout_sec: float) -> bool:
+    """阻塞等待用户选择。True=允许，False=拒绝或超时"""
+    return _broker.submit(req_id, timeout_sec).result()
+
+
+async def wait_async(req_id: str, timeout_sec: float) -> bool:
+    """异步等待用户选择，不占线程；协程被取消时撤销请求"""
+    fut = _broker.submit(req_id, timeout_sec)
+    try:
+        return await asyncio.wrap_future(fut)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
@@ -0,0 +1,265 @@
+"""
+流式命令执行：边运行边读输出，替代 subprocess.run(capture_output=True)
+
+- 后台线程增量读取 stdout/stderr，只保留开头 + 结尾（HeadTailBuffer），内存有上限，
+  报错通常在结尾，不会再被截掉
+- 每次调用可指定超时；超时或 cancel() 时终止整个进程组，返回已收集的输出
+- cancel(task_id) 之后该任务再发起的命令直接返回「已取消」，直到 forget(task_id)
+- 可选：每隔 report_every 秒把最新输出片段通过 middleware.report 推送到 Telegram
+  （report 同时为当前任务续约，长时间构建不会被判定卡死）
+"""
+import os
+import time
+import codecs
+import locale
+import signal
+import logging
+import threading
+import subprocess
+from collections import deque
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = float(os.getenv("RUN_COMMAND_TIMEOUT", "60"))
+MAX_TIMEOUT = float(os.getenv("RUN_COMMAND_MAX_TIMEOUT", "3600"))
+# 运行超过这么多秒后开始定期推送输出片段，0 关闭
+REPORT_EVERY = float(os.getenv("RUN_COMMAND_REPORT_EVERY", "0"))
+REPORT_SNIPPET = 800
+
+
+class HeadTailBuffer:
+    """只保留前 head 个和后 tail 个字符，中间计数丢弃"""
+
+    def __init__(self, head: int, tail: int):
+        self.head_limit = head
+        self.tail_limit = tail
+        self.head: list[str] = []
+        self.head_len = 0
+        self.tail: deque[str] = deque()
+        self.tail_len = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> None:
+        with self._lock:
+            if self.head_len < self.head_limit:
+                take = text[: self.head_limit - self.head_len]
+                self.head.append(take)
+                self.head_len += len(take)
+                text = text[len(take):]
+            if not text:
+                return
+            self.tail.append(text)
+            self.tail_len += len(text)
+            while self.tail_len > self.tail_limit:
+                extra = self.tail_len - self.tail_limit
+                first = self.tail[0]
+                if len(first) <= extra:
+                    self.tail.popleft()
+                    self.tail_len -= len(first)
+                    self.dropped += len(first)
+                else:
+                    self.tail[0] = first[extra:]
+                    self.tail_len -= extra
+                    self.dropped += extra
+
+    def last(self, n: int) -> str:
+        """最近 n 个字符（用于进度片段）"""
+        with self._lock:
+            text = "".join(self.tail) if self.tail else "".join(self.head)
+        return text[-n:]
+
+    def getvalue(self) -> str:
+        with self._lock:
+            head, tail = "".join(self.head), "".join(self.tail)
+            if self.dropped:
+                return f"{head}\n…（中间省略 {self.dropped} 字符）…\n{tail}"
+            return head + tail
+
+
+class CommandRun:
+    """一次命令执行；cancel() 可在其他线程调用"""
+
+    def __init__(self, command: str, cwd: str, task_id: str = ""):
+        self.command = command
+        self.cwd = cwd
+        self.task_id = task_id
+        self.timeout = DEFAULT_TIMEOUT
+        self.stdout = HeadTailBuffer(2000, 4000)
+        self.stderr = HeadTailBuffer(1000, 2000)
+        self.started_at = time.monotonic()
+        self.returncode: int | None = None
+        self.timed_out = False
+        self.cancelled = False
+        self.proc: subprocess.Popen | None = None
+
+    def start(self) -> None:
+        kwargs: dict = {}
+        if os.name == "nt":
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+        self.proc = subprocess.Popen(
+            self.command,
+            shell=True,
+            cwd=self.cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **kwargs,
+        )
+        self._readers = [
+            threading.Thread(target=self._pump, args=(self.proc.stdout, self.stdout), daemon=True),
+            threading.Thread(target=self._pump, args=(self.proc.stderr, self.stderr), daemon=True),
+        ]
+        for t in self._readers:
+            t.start()
+        if self.cancelled:
+            # 启动前一刻被取消
+            self.kill()
+
+    @staticmethod
+    def _pump(pipe, buffer: HeadTailBuffer) -> None:
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace")
+        try:
+            while True:
+                chunk = pipe.read1(65536)
+                if not chunk:
+                    break
+                buffer.write(decoder.decode(chunk))
+            buffer.write(decoder.decode(b"", final=True))
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def kill(self) -> None:
+        """终止整个进程组（shell 启动的子进程一起结束）"""
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        try:
+            if os.name == "nt":
+                self.proc.kill()
+            else:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+        except (OSError, ProcessLookupError):
+            pass
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        self.kill()
+
+    def wait(self, timeout: float, report_every: float = 0.0, on_report: Callable[["CommandRun"], None] | None = None) -> int | None:
+        deadline = self.started_at + timeout
+        next_report = self.started_at + report_every if report_every > 0 else None
+        while True:
+            now = time.monotonic()
+            step = deadline - now
+            if next_report is not None:
+                step = min(step, next_report - now)
+            try:
+                self.returncode = self.proc.wait(timeout=max(step, 0.01))
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            now = time.monotonic()
+            if now >= deadline:
+                self.timed_out = True
+                self.kill()
+                self.returncode = self.proc.wait()
+                break
+            if next_report is not None and now >= next_report:
+                next_report = now + report_every
+                if on_report is not None:
+                    try:
+                        on_report(self)
+                    except Exception as e:
+                        logger.warning(f"推送命令输出失败: {e}")
+        for t in self._readers:
+            t.join(timeout=5)
+        return self.returncode
+
+    def output(self) -> str:
+        out = self.stdout.getvalue()
+        err = self.stderr.getvalue()
+        if err:
+            out += f"\nStderr: {err}"
+        return out
+
+
+_running: dict[int, CommandRun] = {}
+_running_lock = threading.Lock()
+# 已被取消（租约回收等）的任务：之后的命令不再启动
+_cancelled_tasks: set[str] = set()
+
+
+def _report_snippet(run: CommandRun) -> None:
+    import middleware
+
+    elapsed = int(time.monotonic() - run.started_at)
+    out = run.stdout.last(REPORT_SNIPPET)
+    err = run.stderr.last(REPORT_SNIPPET // 2)
+    snippet = (out + ("\n" + err if err else "")).replace("```", "'''").strip()
+    middleware.report(f"⏳ 命令运行中 {elapsed}s", f"`{run.command[:80]}`\n```\n{snippet}\n```", task_id=run.task_id)
+
+
+def run(
+    command: str,
+    cwd: str,
+    timeout: float | None = None,
+    report_every: float | None = None,
+    task_id: str = "",
+) -> CommandRun:
+    """执行命令直到结束、超时或被取消，返回 CommandRun（output()、returncode、timed_out）"""
+    timeout = min(float(timeout or DEFAULT_TIMEOUT), MAX_TIMEOUT)
+    report_every = REPORT_EVERY if report_every is None else report_every
+    cmd = CommandRun(command, cwd, task_id)
+    cmd.timeout = timeout
+    with _running_lock:
+        if task_id and task_id in _cancelled_tasks:
+            cmd.cancelled = True
+            return cmd
+        _running[id(cmd)] = cmd
+    try:
+        cmd.start()
+        cmd.wait(timeout, report_every, _report_snippet if report_every > 0 else None)
+    finally:
+        with _running_lock:
+            _running.pop(id(cmd), None)
+    return cmd
+
+
+def cancel(task_id: str | None = None) -> int:
+    """
+    取消正在运行的命令（task_id 为 None 时取消全部），返回取消的个数
+    指定 task_id 时该任务之后的命令也不再执行
+    """
+    with _running_lock:
+        if task_id:
+            _cancelled_tasks.add(task_id)
+        runs = [r for r in _running.values() if task_id is None or r.task_id == task_id]
+    for r in runs:
+        r.cancel()
+    return len(runs)
+
+
+def active(task_id: str) -> bool:
+    """该任务当前有命令在运行吗"""
+    with _running_lock:
+        return any(r.task_id == task_id for r in _running.values())
+
+
+def is_cancelled(task_id: str) -> bool:
+    """该任务是否已被 cancel（Agent 在轮次之间检查，及早停止）"""
+    with _running_lock:
+        return task_id in _cancelled_tasks
+
+
+def forget(task_id: str) -> None:
+    """任务已结束，清除其取消标记"""
+    with _running_lock:
+        _cancelled_tasks.discard(task_id)
@@ -0,0 +1,164 @@
+"""
+上下文预算：工具循环越长，每轮重发的历史越大，这里把它控制在预算内
+
+- 按字符粗估 token（ASCII 约 4 字符 1 token，中文等约 1 字 1 token）
+- 超过预算时，从最早的工具结果开始替换为「已省略」摘要（保留开头一小段），
+  一直压到预算的 LOW_WATERMARK 为止；最近一轮的工具结果始终原样保留
+- 一次压到低水位，之后若干轮前缀不变，prompt 缓存仍能命中
+- Gemini 的长期会话（AntiGravityAgent）在省略后仍超预算时，再丢弃最早的整轮对话
+
+Claude 用 compact_claude(messages)，Gemini 用 compact_gemini(history)，均原地修改。
+"""
+import os
+import logging
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# 每次请求的历史上限（估算 token 数），0 关闭
+CONTEXT_BUDGET = int(os.getenv("AGENT_CONTEXT_BUDGET", "60000"))
+# 超预算后压到预算的多少比例
+LOW_WATERMARK = 0.6
+# 省略后保留的开头字符数
+ELIDED_HEAD = 300
+# 末尾这么多条消息不动（最近一轮工具调用与结果）
+KEEP_RECENT = 2
+ELIDED_MARK = "[旧工具结果已省略以节省上下文"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 数"""
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def _elide(text: str) -> str:
+    if text.startswith(ELIDED_MARK) or len(text) <= ELIDED_HEAD * 2:
+        return text
+    return f"{ELIDED_MARK}：原 {len(text)} 字符，开头如下]\n{text[:ELIDED_HEAD]}…"
+
+
+def _budget(budget: int | None) -> int:
+    return CONTEXT_BUDGET if budget is None else budget
+
+
+# ============ Claude：messages 为 dict 列表 ============
+def _claude_block_text(block: Any) -> str:
+    if isinstance(block, str):
+        return block
+    get = block.get if isinstance(block, dict) else (lambda k: getattr(block, k, None))
+    for key in ("text", "content", "input"):
+        value = get(key)
+        if value:
+            return value if isinstance(value, str) else str(value)
+    return ""
+
+
+def _claude_tokens(message: dict[str, Any]) -> int:
+    content = message["content"]
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    return sum(estimate_tokens(_claude_block_text(b)) for b in content)
+
+
+def compact_claude(messages: list[dict[str, Any]], budget: int | None = None) -> int:
+    """超预算时省略旧的 tool_result，返回省略的条数"""
+    budget = _budget(budget)
+    if budget <= 0:
+        return 0
+    sizes = [_claude_tokens(m) for m in messages]
+    total = before = sum(sizes)
+    if total <= budget:
+        return 0
+    target = int(budget * LOW_WATERMARK)
+    elided = 0
+    for i, message in enumerate(messages[:-KEEP_RECENT]):
+        if total <= target:
+            break
+        if message["role"] != "user" or isinstance(message["content"], str):
+            continue
+        blocks = []
+        for block in message["content"]:
+            if isinstance(block, dict) and block.get("type") == "tool_result" and isinstance(block.get("content"), str):
+                short = _elide(block["content"])
+                if short is not block["content"]:
+                    block = {**block, "content": short}
+                    elided += 1
+            blocks.append(block)
+        message["content"] = blocks
+        new_size = _claude_tokens(message)
+        total -= sizes[i] - new_size
+        sizes[i] = new_size
+    if elided:
+        logger.info(f"上下文压缩: 省略 {elided} 个旧工具结果，约 {before} → {total} tokens")
+    return elided
+
+
+# ============ Gemini：history 为 types.Content 列表 ============
+def _gemini_part_text(part: Any) -> str:
+    if getattr(part, "text", None):
+        return part.text
+    if getattr(part, "function_call", None):
+        return str(part.function_call.args or "")
+    if getattr(part, "function_response", None):
+        return str(part.function_response.response or "")
+    return ""
+
+
+def _gemini_tokens(content: Any) -> int:
+    return sum(estimate_tokens(_gemini_part_text(p)) for p in (content.parts or []))
+
+
+def _is_user_text(content: Any) -> bool:
+    """用户发来的新消息（而不是工具结果），可以作为丢弃整轮时的边界"""
+    return content.role == "user" and any(getattr(p, "text", None) for p in (content.parts or []))
+
+
+def compact_gemini(history: list[Any], budget: int | None = None, drop_turns: bool = False) -> int:
+    """超预算时省略旧的 function_response；drop_turns=True 时仍超预算则丢弃最早的整轮对话。返回省略/丢弃的条数"""
+    budget = _budget(budget)
+    if budget <= 0:
+        return 0
+    sizes = [_gemini_tokens(c) for c in history]
+    total = before = sum(sizes)
+    if total <= budget:
+        return 0
+    from google.genai import types
+
+    target = int(budget * LOW_WATERMARK)
+    elided = 0
+    for i, content in enumerate(history[:-KEEP_RECENT]):
+        if total <= target:
+            break
+        parts = content.parts or []
+        for j, part in enumerate(parts):
+            fr = getattr(part, "function_response", None)
+            if not fr or not isinstance(fr.response, dict) or not isinstance(fr.response.get("result"), str):
+                continue
+            short = _elide(fr.response["result"])
+            if short is not fr.response["result"]:
+                parts[j] = types.Part.from_function_response(name=fr.name, response={"result": short})
+                elided += 1
+        new_size = _gemini_tokens(content)
+        total -= sizes[i] - new_size
+        sizes[i] = new_size
+
+    dropped = 0
+    if drop_turns and total > target:
+        # 从最早的一轮开始整轮丢弃，保证剩下的历史仍以用户消息开头
+        cut = 0
+        for i in range(1, len(history) - KEEP_RECENT + 1):
+            if total <= target:
+                break
+            if _is_user_text(history[i]):
+                total -= sum(sizes[cut:i])
+                cut = i
+        if cut:
+            dropped = cut
+            del history[:cut]
+
+    if elided or dropped:
+        logger.info(f"上下文压缩: 省略 {elided} 个旧工具结果、丢弃 {dropped} 条旧消息，约 {before} → {total} tokens")
+    return elided + dropped
@@ -1,62 +1,77 @@
 """
-daemon.py - 四步循环，统一覆盖三种情景
+daemon.py - 四步循环，统一覆盖三种情景，支持 N 个并行槽位
 
-每 10 秒：
-  1. 有新任务吗？  → 没有 → sleep 继续
-  2. Agent 在忙吗？ → 在忙 → 任务排队，继续
-  3. 唤起 Agent     → 开新会话，喂任务
-  4. 标记 Agent 忙
+新任务 / 任务完成时由 notify 即时唤醒（每 10 秒兜底检查一次）：
+  1. 有新任务吗？  → 没有 → 等待唤醒
+  2. 有空闲槽位吗？ → 没有 → 任务排队，继续
+  3. 唤起 Agent     → 开新会话，喂任务（每个槽位一个 current_task_<slot>.md）
+  4. 标记槽位忙     → 任务进入 running 表并持有租约，report_done 按 task_id 和租约令牌释放槽位
+
+租约由 report_progress 续约；过期（Agent 崩溃/卡死）的任务自动回收重新入队，
+多次过期判定失败并通知用户，队列不会因为一个卡死的会话停住。
+
+DAEMON_MODE=headless：不操控 Cursor 界面，直接在线程池里调用 mcp_agent.process
+（或 HEADLESS_AGENT 指定的 agents.BaseAgent 实现），结果经 report_done 推送。
+适合无界面的 Linux 服务器，派发开销从秒级降到毫秒级。
+工作线程活着时 daemon 代为续约，同一任务不会在两个线程里同时运行；
+租约期内没有进展（Agent 事件、运行中的命令）或总时长超过 HEADLESS_MAX_RUNTIME 时取消它：
+终止其命令，Agent 在下一个事件/轮次处停止，线程退出后任务按重试次数重新入队或判定失败。
 """
 import os
 import sys
-import glob
 import time
 import subprocess
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import notify
+import task_queue
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-TASK_PREFIX = ".tg_task_"
-CURRENT_TASK = os.path.join(BASE_DIR, "current_task.md")
-DAEMON_WAITING = os.path.join(BASE_DIR, ".daemon_waiting")
-DAEMON_DONE = os.path.join(BASE_DIR, ".daemon_task_done")
-AGENT_BUSY = os.path.join(BASE_DIR, ".agent_busy")
 POLL_INTERVAL = int(os.getenv("DAEMON_POLL_INTERVAL", "10"))
-TASK_TIMEOUT = 1800
+SLOTS = max(int(os.getenv("DAEMON_SLOTS", "1")), 1)
+HEADLESS = os.getenv("DAEMON_MODE", "cursor").lower() == "headless"
+HEADLESS_AGENT = os.getenv("HEADLESS_AGENT", "mcp").lower()
+# 无界面任务的最长运行时间（秒），超过后不再续约
+HEADLESS_MAX_RUNTIME = float(os.getenv("HEADLESS_MAX_RUNTIME", "7200"))
 CURSOR_EXE = os.getenv("CURSOR_EXE") or os.path.expandvars(r"%LOCALAPPDATA%\Programs\cursor\Cursor.exe")
 
 
-def _trigger_msg():
-    return f"请读取 {CURRENT_TASK} 并执行任务，完成后调用 report_done"
+def _task_file(slot: int) -> str:
+    """每个槽位自己的任务文件"""
+    return os.path.join(BASE_DIR, f"current_task_{slot}.md")
+
+
+def _trigger_msg(slot: int, task_id: str, token: str) -> str:
+    return (
+        f"请读取 {_task_file(slot)} 并执行任务，完成后调用 report_done"
+        f"（task_id 填 {task_id}，lease 填 {token}；report_progress 同样带上这两个参数）"
+    )
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def _has_task() -> bool:
-    """有新任务吗？（不消费）"""
-    return bool(glob.glob(os.path.join(BASE_DIR, f"{TASK_PREFIX}*.txt")))
+def _owner_prefix() -> str:
+    return "headless:" if HEADLESS else "daemon:"
 
 
-def _agent_busy() -> bool:
-    """Agent 在忙吗？"""
-    return os.path.exists(AGENT_BUSY)
+def _has_task() -> bool:
+    """有新任务吗？（不消费）"""
+    return task_queue.has_pending()
 
 
-def _get_next_task() -> tuple[str, str] | None:
-    """消费一个任务，返回 (task_id, content) 或 None"""
-    files = sorted(glob.glob(os.path.join(BASE_DIR, f"{TASK_PREFIX}*.txt")))
-    if not files:
-        return None
-    path = files[0]
+def _claim(slot: int) -> tuple[str, str, str] | None:
+    """为 slot 领取一个任务，返回 (task_id, content, token) 或 None"""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-        task_id = os.path.basename(path).replace(TASK_PREFIX, "").replace(".txt", "")
-        os.remove(path)
-        return task_id, content
+        task = task_queue.claim_for(slot, owner=f"{_owner_prefix()}{os.getpid()}:{slot}")
     except Exception as e:
         logger.warning(f"读取任务失败: {e}")
         return None
+    if not task:
+        return None
+    task_id, content, token = task
+    return task_id, content.strip(), token
 
 
 def _ensure_cursor() -> bool:
@@ -78,7 +93,7 @@ def _ensure_cursor() -> bool:
     return False
 
 
-def _trigger_cursor() -> bool:
+def _trigger_cursor(slot: int, task_id: str, token: str) -> bool:
     """模拟 Ctrl+I 唤起 Agent"""
     try:
         import pyautogui
@@ -97,91 +112,238 @@ def _trigger_cursor() -> bool:
         pass
     pyautogui.hotkey("ctrl", "i")
     time.sleep(0.8)
-    pyperclip.copy(_trigger_msg())
+    pyperclip.copy(_trigger_msg(slot, task_id, token))
     pyautogui.hotkey("ctrl", "v")
     time.sleep(0.2)
     pyautogui.press("enter")
     return True
 
 
-def _wait_for_done() -> bool:
-    deadline = time.time() + TASK_TIMEOUT
-    while time.time() < deadline:
-        if os.path.exists(DAEMON_DONE):
-            try:
-                os.remove(DAEMON_DONE)
-                return True
-            except Exception:
-                pass
-        time.sleep(2)
-    return False
-
+def _free_slot(slot: int) -> None:
+    try:
+        os.remove(_task_file(slot))
+    except Exception:
+        pass
 
-def main():
-    os.chdir(BASE_DIR)
-    logger.info("daemon 已启动，每 %d 秒循环", POLL_INTERVAL)
 
-    while True:
-        # 1. 有新任务吗？
-        if not _has_task():
-            time.sleep(POLL_INTERVAL)
+def _reap_leases() -> None:
+    """回收租约过期（Agent 崩溃/卡死、从未 report_done）的任务：重新入队或判定失败"""
+    try:
+        reaped = task_queue.reap_expired()
+    except Exception as e:
+        logger.warning(f"回收租约失败: {e}")
+        return
+    for task_id, content, requeued in reaped:
+        if requeued:
+            logger.warning("任务 %s 租约过期，已重新入队", task_id[:8])
             continue
+        logger.error("任务 %s 多次租约过期，判定失败", task_id[:8])
+        try:
+            from middleware import _send
+            _send(f"❌ **【任务失败】** `{task_id}`\n\nAgent 多次未在租约期内汇报，已放弃：\n\n{content[:500]}")
+        except Exception as e:
+            logger.warning(f"通知任务失败出错: {e}")
 
-        # 2. Agent 在忙吗？→ 任务排队，继续
-        if _agent_busy():
-            time.sleep(POLL_INTERVAL)
+
+def _collect_finished(slots: dict[int, tuple[str, str, float] | None]) -> None:
+    """report_done 完成、或租约被回收的任务已不在 running 表 → 释放槽位"""
+    _reap_leases()
+    running = task_queue.running()
+    for slot, cur in slots.items():
+        if cur is None:
             continue
+        task_id = cur[0]
+        if task_id in running:
+            continue
+        worker = _workers.get(task_id)
+        if worker is not None and not worker.done():
+            # 任务已不在 running 表而线程还在跑（正在收尾，或租约意外被回收）：
+            # 取消它并保持槽位占用，线程退出后再释放，避免同一任务并发执行
+            import command_runner
 
-        # 3. 唤起 Agent
-        task = _get_next_task()
-        if not task:
-            time.sleep(POLL_INTERVAL)
+            if not command_runner.is_cancelled(task_id):
+                n = command_runner.cancel(task_id)
+                logger.warning("任务 %s 已不在运行表，取消其 %d 个运行中的命令", task_id[:8], n)
             continue
+        if worker is not None:
+            import command_runner
 
-        task_id, content = task
-        logger.info("唤起 Agent，任务 %s", task_id[:8])
+            command_runner.forget(task_id)
+        _workers.pop(task_id, None)
+        _last_progress.pop(task_id, None)
+        logger.info("槽位 %d 任务 %s 结束", slot, task_id[:8])
+        slots[slot] = None
+        _free_slot(slot)
 
-        if not _ensure_cursor():
-            from middleware import write_task
-            write_task(content)
-            logger.warning("Cursor 未就绪，任务已回队列")
-            time.sleep(POLL_INTERVAL)
-            continue
 
-        with open(CURRENT_TASK, "w", encoding="utf-8") as f:
-            f.write(content)
-        with open(DAEMON_WAITING, "w") as f:
-            f.write(task_id)
-        # 4. 标记 Agent 忙
-        with open(AGENT_BUSY, "w") as f:
-            f.write(task_id)
-
-        if not _trigger_cursor():
-            from middleware import write_task
-            write_task(content)
-            for p in (AGENT_BUSY, DAEMON_WAITING, CURRENT_TASK):
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
-            time.sleep(POLL_INTERVAL)
-            continue
+def _start(slot: int, task_id: str, token: str, content: str) -> bool:
+    """在槽位上唤起 Agent，失败时任务回到队列原位置"""
+    logger.info("槽位 %d 唤起 Agent，任务 %s", slot, task_id[:8])
+    if HEADLESS:
+        _workers[task_id] = _executor.submit(_run_headless, slot, task_id, token, content)
+        return True
+    if not _ensure_cursor():
+        task_queue.release(task_id)
+        logger.warning("Cursor 未就绪，任务已回队列")
+        return False
+
+    with open(_task_file(slot), "w", encoding="utf-8") as f:
+        f.write(content)
+    if not _trigger_cursor(slot, task_id, token):
+        task_queue.release(task_id)
+        _free_slot(slot)
+        return False
+    return True
+
+
+# ============ 无界面模式 ============
+_executor = ThreadPoolExecutor(max_workers=SLOTS, thread_name_prefix="agent-slot")
+# task_id -> 工作线程的 Future
+_workers: dict[str, Future] = {}
+# task_id -> 最近一次 Agent 事件的时间
+_last_progress: dict[str, float] = {}
+
+
+def _turn(task_id: str) -> bool:
+    """Agent 每有一个事件/轮次调用一次：记录进展，返回是否继续（已被取消则 False）"""
+    import command_runner
+
+    _last_progress[task_id] = time.time()
+    return not command_runner.is_cancelled(task_id)
+
+
+def _headless_process(content: str, task_id: str) -> str:
+    """按 HEADLESS_AGENT 选择执行者：mcp（默认，mcp_agent.process_stream）或 antigravity"""
+    if HEADLESS_AGENT == "antigravity":
+        from agents.antigravity_agent import AntiGravityAgent
+
+        # 每个任务一个实例，history 不跨任务共享
+        agent = AntiGravityAgent(os.environ.get("GEMINI_API_KEY", ""), task_id=task_id, on_turn=lambda: _turn(task_id))
+        return agent.process_message(content)
+    from mcp_agent import process_stream
+
+    text = ""
+    for event in process_stream(content, task_id=task_id):
+        if not _turn(task_id):
+            return "任务已取消。"
+        if event["type"] == "done":
+            text = event["text"]
+    return text
+
+
+def _abandon(task_id: str, token: str) -> None:
+    """被取消的任务：线程已退出，按重试次数重新入队或判定失败"""
+    from middleware import _send
+
+    outcome = task_queue.abandon(task_id, token=token)
+    if outcome is None:
+        return
+    content, requeued = outcome
+    if requeued:
+        logger.warning("任务 %s 长时间无进展已取消，重新入队", task_id[:8])
+        notify.ring(notify.TASK_CHANNEL)
+    else:
+        logger.error("任务 %s 多次无进展，判定失败", task_id[:8])
+        _send(f"❌ **【任务失败】** `{task_id}`\n\nAgent 多次长时间无进展，已放弃：\n\n{content[:500]}")
+    notify.ring(notify.DONE_CHANNEL)
+
+
+def _run_headless(slot: int, task_id: str, token: str, content: str) -> None:
+    """工作线程：执行任务并经 report_done 推送结果（report_done 会释放槽位）"""
+    import command_runner
+    from middleware import report_done, _send
+
+    error = None
+    try:
+        result = _headless_process(content, task_id)
+    except Exception as e:
+        result, error = "", e
+    cancelled = command_runner.is_cancelled(task_id)
+    # 先清除标记再放回队列，重新领取后的执行不受影响
+    command_runner.forget(task_id)
+    if cancelled:
+        _abandon(task_id, token)
+    elif error is not None:
+        logger.error("槽位 %d 任务 %s 执行失败: %s", slot, task_id[:8], error)
+        _send(f"❌ **【任务失败】** `{task_id}`\n\n{error}")
+        if task_queue.complete(task_id, token=token):
+            notify.ring(notify.DONE_CHANNEL)
+    else:
+        report_done(result or "（无回复）", task_id=task_id, lease=token)
+
 
-        _wait_for_done()
+def _renew_headless(slots: dict[int, tuple[str, str, float] | None]) -> None:
+    """
+    本进程的工作线程活着 → 为它们续约（线程退出前任务不会被回收、重复执行）
+    长时间无进展或超过最长运行时间的，取消它，等线程退出后由 _abandon 处理
+    """
+    import command_runner
 
-        for p in (DAEMON_WAITING, CURRENT_TASK):
-            try:
-                if os.path.exists(p):
-                    os.remove(p)
-            except Exception:
-                pass
-        # .agent_busy 由 report_done 移除
+    now = time.time()
+    for cur in slots.values():
+        if cur is None:
+            continue
+        task_id, token, started = cur
+        worker = _workers.get(task_id)
+        if worker is None or worker.done():
+            continue
+        if not command_runner.is_cancelled(task_id):
+            idle = now - _last_progress.get(task_id, started)
+            overtime = now - started > HEADLESS_MAX_RUNTIME
+            if overtime or (idle > task_queue.LEASE_TTL and not command_runner.active(task_id)):
+                n = command_runner.cancel(task_id)
+                logger.warning(
+                    "任务 %s %s，取消（终止 %d 个命令）", task_id[:8],
+                    "超过最长运行时间" if overtime else f"{int(idle)} 秒无进展", n,
+                )
         try:
-            if os.path.exists(AGENT_BUSY):
-                os.remove(AGENT_BUSY)
-        except Exception:
-            pass
-        logger.info("任务 %s 完成，继续轮询", task_id[:8])
+            task_queue.renew(task_id, token=token)
+        except Exception as e:
+            logger.warning(f"续约失败: {e}")
+
+
+def main():
+    os.chdir(BASE_DIR)
+    logger.info(
+        "daemon 已启动（%s 模式），%d 个槽位，新任务即时唤醒，兜底每 %d 秒检查",
+        "headless" if HEADLESS else "cursor", SLOTS, POLL_INTERVAL,
+    )
+    bell = notify.Doorbell(notify.TASK_CHANNEL, notify.DONE_CHANNEL)
+
+    # 接管上次遗留的运行中任务（租约仍有效时继续等待，过期由 _reap_leases 回收）
+    # 无界面模式的遗留任务随上个进程一起没了，直接放回队列
+    slots: dict[int, tuple[str, str, float] | None] = {i: None for i in range(SLOTS)}
+    for lease in task_queue.leases():
+        task_id, slot = lease["task_id"], lease["slot"]
+        if HEADLESS:
+            if lease["owner"].startswith("headless:"):
+                task_queue.release(task_id)
+        elif slot in slots and slots[slot] is None:
+            slots[slot] = (task_id, task_queue.lease_token(lease["owner"], lease["attempts"]), time.time())
+        else:
+            task_queue.release(task_id)
+
+    while True:
+        if HEADLESS:
+            _renew_headless(slots)
+        _collect_finished(slots)
+
+        # 1. 有新任务吗？ 2. 有空闲槽位吗？
+        free = [i for i, cur in slots.items() if cur is None]
+        if not free or not _has_task():
+            bell.wait(POLL_INTERVAL)
+            continue
+
+        # 3. 唤起 Agent  4. 标记槽位忙
+        slot = free[0]
+        task = _claim(slot)
+        if not task:
+            continue
+        task_id, content, token = task
+        if _start(slot, task_id, token, content):
+            slots[slot] = (task_id, token, time.time())
+        else:
+            time.sleep(POLL_INTERVAL)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,326 @@
+r"""
+grep_search 的搜索引擎：并发、遵守 .gitignore、找够结果立即停止
+
+- os.scandir 遍历，跳过 SKIP_DIRS 和 .gitignore 忽略的目录/文件（不进入被忽略的目录）
+- 读开头 8KB，含 NUL 视为二进制，直接跳过
+- 整个文件按字节跑正则（大文件用 mmap），没有命中就不解码、不拆行；
+  命中后再定位所在行并按行确认（去掉行尾 \r），结果与逐行搜索一致
+- 字节正则只用于语义与文本正则相同的模式；含 . [] \w \b \s \d $ 等时按文本搜索（CRLF 统一为 \n）
+- 文件在线程池里并发扫描，按遍历顺序收集结果；够 max_results 条即停止遍历并取消剩余任务
+"""
+import os
+import re
+import mmap
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".tox", ".mypy_cache", ".pytest_cache"}
+GREP_WORKERS = int(os.getenv("GREP_WORKERS", "8"))
+BINARY_SNIFF = 8192
+# 超过这个大小用 mmap，不整体读入内存
+MMAP_THRESHOLD = 1024 * 1024
+MAX_LINE_CHARS = 500
+
+_pool = ThreadPoolExecutor(max_workers=max(GREP_WORKERS, 1), thread_name_prefix="grep")
+
+
+# ============ .gitignore ============
+def _glob_to_regex(pattern: str) -> str:
+    out, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**/", i):
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 1)
+            if j == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = j
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def compile_glob(pattern: str) -> re.Pattern:
+    """glob 模式（相对路径，/ 分隔）编译为正则：* 不跨目录，**/ 匹配任意层"""
+    return re.compile(_glob_to_regex(pattern) + r"\Z")
+
+
+class GitIgnore:
+    """一个目录下 .gitignore 的规则（支持 !、结尾 /、带 / 的锚定、*、**、?、[]）"""
+
+    def __init__(self, base: str, lines: Iterable[str]):
+        self.base = base
+        self.rules: list[tuple[re.Pattern, bool, bool, bool]] = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            anchored = "/" in line
+            regex = re.compile(_glob_to_regex(line.lstrip("/")) + r"\Z")
+            self.rules.append((regex, negate, dir_only, anchored))
+
+    @classmethod
+    def load(cls, directory: str) -> "GitIgnore | None":
+        try:
+            with open(os.path.join(directory, ".gitignore"), "r", encoding="utf-8", errors="replace") as f:
+                ignore = cls(directory, f)
+        except OSError:
+            return None
+        return ignore if ignore.rules else None
+
+    def match(self, path: str, is_dir: bool) -> bool | None:
+        """True=忽略，False=显式不忽略（!规则），None=没有规则匹配"""
+        rel = os.path.relpath(path, self.base).replace(os.sep, "/")
+        name = rel.rsplit("/", 1)[-1]
+        result = None
+        for regex, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel if anchored else name):
+                result = not negate
+        return result
+
+
+def _ignored(ignores: list[GitIgnore], path: str, is_dir: bool) -> bool:
+    # 越深的 .gitignore 优先
+    for ignore in reversed(ignores):
+        hit = ignore.match(path, is_dir)
+        if hit is not None:
+            return hit
+    return False
+
+
+def _ignores_above(base: str, path: str) -> list[GitIgnore]:
+    """base 到 path 之间（含 base，不含 path）各级目录的 .gitignore，由浅到深"""
+    base, path = os.path.abspath(base), os.path.abspath(path)
+    rel = os.path.relpath(path, base)
+    if rel == "." or rel.startswith(".."):
+        return []
+    ignores: list[GitIgnore] = []
+    current = base
+    for name in rel.split(os.sep):
+        own = GitIgnore.load(current)
+        if own is not None:
+            ignores.append(own)
+        current = os.path.join(current, name)
+    return ignores
+
+
+def iter_entries(
+    root: str, use_gitignore: bool = True, max_depth: int | None = None, base: str | None = None
+) -> Iterator[os.DirEntry]:
+    """
+    按名称顺序深度优先遍历 root：先产出一个目录里的文件和子目录，再依次进入子目录
+    跳过 SKIP_DIRS 和 .gitignore 忽略的条目；max_depth=0 表示只看 root 本层
+    base 为 root 的上层目录时，同时应用 base 到 root 之间的 .gitignore（与从 base 遍历到 root 时一致）
+    """
+
+    def walk(directory: str, ignores: list[GitIgnore], depth: int) -> Iterator[os.DirEntry]:
+        if use_gitignore:
+            own = GitIgnore.load(directory)
+            if own is not None:
+                ignores = ignores + [own]
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SKIP_DIRS and not _ignored(ignores, entry.path, True):
+                        subdirs.append(entry)
+                        yield entry
+                elif entry.is_file(follow_symlinks=False):
+                    if not _ignored(ignores, entry.path, False):
+                        yield entry
+            except OSError:
+                continue
+        if max_depth is not None and depth >= max_depth:
+            return
+        for entry in subdirs:
+            yield from walk(entry.path, ignores, depth + 1)
+
+    ignores = _ignores_above(base, root) if use_gitignore and base else []
+    yield from walk(os.path.abspath(root), ignores, 0)
+
+
+def is_pruned(root: str, path: str) -> bool:
+    """从 root 遍历时，path（root 下的目录或文件）本身或其上层目录是否会被跳过（SKIP_DIRS / .gitignore）"""
+    root, path = os.path.abspath(root), os.path.abspath(path)
+    rel = os.path.relpath(path, root)
+    if rel == "." or rel.startswith(".."):
+        return False
+    parts = rel.split(os.sep)
+    ignores: list[GitIgnore] = []
+    current = root
+    for i, name in enumerate(parts):
+        own = GitIgnore.load(current)
+        if own is not None:
+            ignores = ignores + [own]
+        current = os.path.join(current, name)
+        is_dir = i < len(parts) - 1 or os.path.isdir(current)
+        if (is_dir and name in SKIP_DIRS) or _ignored(ignores, current, is_dir):
+            return True
+    return False
+
+
+def iter_files(root: str, use_gitignore: bool = True, base: str | None = None) -> Iterator[os.DirEntry]:
+    """按名称顺序深度优先遍历 root 下的文件（先文件后子目录），跳过忽略的目录和文件；base 同 iter_entries"""
+    for entry in iter_entries(root, use_gitignore, base=base):
+        if not entry.is_dir(follow_symlinks=False):
+            yield entry
+
+
+# ============ 扫描 ============
+# 模式里的转义或元字符；字节正则下含义不同的见 _bytes_safe
+_TOKEN = re.compile(r"\\(.)|[.\[$]", re.DOTALL)
+# 字节正则与文本正则含义相同的字母/数字转义
+_SAFE_ESCAPES = set("nrtfvA123456789")
+
+
+def _bytes_safe(pattern: str) -> bool:
+    r"""
+    按字节匹配是否与按行匹配文本的结果一致：
+    . 和 [] 在字节下只匹配一个字节，\w \b \s \d 等只认 ASCII，
+    $ 在 CRLF 文件里匹配不到 \r 之前，这些都交给文本正则
+    """
+    if not pattern.isascii():
+        return False
+    for m in _TOKEN.finditer(pattern):
+        escaped = m.group(1)
+        if escaped is None or (escaped.isalnum() and escaped not in _SAFE_ESCAPES):
+            return False
+    return True
+
+
+def compile_pattern(pattern: str, ignore_case: bool = True) -> re.Pattern:
+    """能按字节安全匹配的模式编译为字节正则，直接在原始字节上搜索；其余编译为文本正则"""
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    if _bytes_safe(pattern):
+        return re.compile(pattern.encode("ascii"), flags)
+    return re.compile(pattern, flags)
+
+
+def _count(buf, nl, start: int, end: int) -> int:
+    if isinstance(buf, mmap.mmap):
+        return buf[start:end].count(nl)
+    return buf.count(nl, start, end)
+
+
+def _lines_matching(regex: re.Pattern, buf, limit: int) -> list[tuple[int, str]]:
+    """在整个缓冲区里找命中的行：(行号, 行内容)。跨行的命中按行重新确认"""
+    found: list[tuple[int, str]] = []
+    nl, cr = (b"\n", b"\r") if isinstance(buf, (bytes, mmap.mmap)) else ("\n", "\r")
+    pos, lineno, counted = 0, 1, 0
+    while len(found) < limit:
+        m = regex.search(buf, pos)
+        if m is None:
+            break
+        start = buf.rfind(nl, 0, m.start()) + 1
+        end = buf.find(nl, m.start())
+        if end == -1:
+            end = len(buf)
+        lineno += _count(buf, nl, counted, start)
+        counted = start
+        line = buf[start:end]
+        if line.endswith(cr):
+            line = line[:-1]
+        if regex.search(line):
+            if not isinstance(line, str):
+                line = line.decode("utf-8", errors="replace")
+            found.append((lineno, line.rstrip()[:MAX_LINE_CHARS]))
+        pos = end + 1
+        if pos > len(buf):
+            break
+    return found
+
+
+def scan_file(regex: re.Pattern, path: str, limit: int, skip_binary: bool = True) -> list[tuple[int, str]]:
+    """在一个文件里搜索，最多返回 limit 行；二进制文件（skip_binary 时）和读不了的文件返回空"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(BINARY_SNIFF)
+            if not head or (skip_binary and b"\0" in head):
+                return []
+            size = os.fstat(f.fileno()).st_size
+            if isinstance(regex.pattern, str):
+                f.seek(0)
+                # 与文本方式逐行读取一致：CRLF 视为一个换行，$ 能匹配到 \r 之前
+                buf = f.read().decode("utf-8", errors="replace").replace("\r\n", "\n")
+                return _lines_matching(regex, buf, limit)
+            if size > MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return _lines_matching(regex, mm, limit)
+            buf = head + f.read() if len(head) == BINARY_SNIFF else head
+            return _lines_matching(regex, buf, limit)
+    except (OSError, ValueError):
+        return []
+
+
+def search(
+    regex: re.Pattern,
+    files: Iterable[str],
+    max_results: int = 20,
+    skip_binary: bool = True,
+) -> list[tuple[str, int, str]]:
+    """
+    并发扫描 files，按 files 的顺序返回最多 max_results 条 (路径, 行号, 行)
+    同时在途的文件数有上限；结果够了就不再取下一个文件，并取消还没开始的任务
+    """
+    results: list[tuple[str, int, str]] = []
+    if max_results <= 0:
+        return results
+    window = max(GREP_WORKERS, 1) * 4
+    pending: deque = deque()
+    it = iter(files)
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < window:
+            path = next(it, None)
+            if path is None:
+                exhausted = True
+                break
+            pending.append((path, _pool.submit(scan_file, regex, path, max_results, skip_binary)))
+        if not pending:
+            break
+        path, fut = pending.popleft()
+        for lineno, line in fut.result():
+            results.append((path, lineno, line))
+            if len(results) >= max_results:
+                for _, rest in pending:
+                    rest.cancel()
+                return results
+    return results
@@ -0,0 +1,94 @@
+"""
+大文件按行定位：稀疏行偏移索引 + mmap
+
+- 每 STRIDE 行记录一次该行起始字节偏移，200MB 日志也只占几千个整数
+- 按需向后扩展：只扫描到请求的行为止；扫描用 split + accumulate，逐行开销在 C 里
+- 按 (mtime, size) 缓存每个文件的索引，文件变化后重建
+- 定位第 N 行 = 取最近的检查点 + 最多 STRIDE 次 find，与文件大小、行号无关
+"""
+import os
+import threading
+from collections import OrderedDict
+from itertools import accumulate, islice
+
+STRIDE = 1000
+CHUNK = 4 * 1024 * 1024
+MAX_INDEXES = 32
+
+
+class LineIndex:
+    """一个文件的稀疏行偏移索引。行号从 0 开始，offsets[k] 为第 k*STRIDE 行的起始偏移"""
+
+    def __init__(self, sig: tuple[int, int]):
+        self.sig = sig
+        self.size = sig[1]
+        self.offsets: list[int] = []
+        self.scanned_pos = 0  # 已扫描到的字节位置
+        self.line_start = 0  # 当前未扫描完的行的起始偏移
+        self.scanned_lines = 0  # 已扫描完的行数
+        self.complete = False
+        self.lock = threading.Lock()
+
+    def extend(self, mm, target_line: int | None = None) -> None:
+        """向后扫描，直到已扫描行数超过 target_line；None 表示扫描到文件末尾"""
+        while not self.complete and (target_line is None or self.scanned_lines <= target_line):
+            pos = self.scanned_pos
+            end = min(pos + CHUNK, self.size)
+            chunk = mm[pos:end]
+            if end < self.size:
+                cut = chunk.rfind(b"\n")
+                if cut == -1:
+                    # 超长的一行跨越整个块，行首仍是 line_start
+                    self.scanned_pos = end
+                    continue
+                parts = chunk[:cut].split(b"\n")
+                next_pos = pos + cut + 1
+            else:
+                self.complete = True
+                if not chunk:
+                    parts = [b""] if self.line_start < self.size else []
+                else:
+                    parts = (chunk[:-1] if chunk.endswith(b"\n") else chunk).split(b"\n")
+                next_pos = end
+            # 本块第 j 行的起始偏移 = pos + 前 j 段长度之和 + j 个换行（第 0 行为 line_start）
+            base, count = self.scanned_lines, len(parts)
+            want = len(self.offsets) * STRIDE
+            if base <= want < base + count:
+                j0 = want - base
+                cums = islice(accumulate(map(len, parts), initial=0), j0, count, STRIDE)
+                for j, cum in zip(range(j0, count, STRIDE), cums):
+                    self.offsets.append(self.line_start if j == 0 else pos + cum + j)
+            self.scanned_lines = base + count
+            self.scanned_pos = self.line_start = next_pos
+
+    def total_lines(self, mm) -> int:
+        self.extend(mm)
+        return self.scanned_lines
+
+    def line_offset(self, mm, line: int) -> int | None:
+        """第 line 行（从 0 开始）的起始偏移；超出文件返回 None"""
+        self.extend(mm, line)
+        if line >= self.scanned_lines:
+            return None
+        k = line // STRIDE
+        pos = self.offsets[k]
+        for _ in range(line - k * STRIDE):
+            pos = mm.find(b"\n", pos) + 1
+        return pos
+
+
+_indexes: "OrderedDict[str, LineIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get(path: str, st: os.stat_result) -> LineIndex:
+    """path 的行索引（按 mtime/size 校验，变化则新建）"""
+    sig = (st.st_mtime_ns, st.st_size)
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None or index.sig != sig:
+            index = _indexes[path] = LineIndex(sig)
+        _indexes.move_to_end(path)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+        return index
@@ -5,18 +5,45 @@ Telegram Agent Bot - 永动机
 无需打开 Cursor 窗口，无需 UI 操控。
 """
 import os
-import glob
+import time
+import hashlib
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 
+import approvals
+import task_queue
+import telegram_client
+from middleware import write_task
+
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ALLOWED_USER_IDS = os.getenv("ALLOWED_USER_IDS", "")
 allowed_users = [int(uid.strip()) for uid in ALLOWED_USER_IDS.split(",") if uid.strip().isdigit()]
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# queue=写入任务队列交给 Agent；direct=由 mcp_agent 直接处理并流式回复
+BOT_AGENT_MODE = os.getenv("BOT_AGENT_MODE", "queue").strip().lower()
+# 流式回复时两次编辑消息的最小间隔（秒），避免触发 Telegram 限流
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_MAX_TEXT = 4000
+# 最终回复编辑失败时的重试次数，仍失败则改为发新消息
+FINAL_EDIT_ATTEMPTS = 3
+# 只接收会处理的更新类型
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# 配置 BOT_WEBHOOK_URL（公网地址，如 https://example.com）即改用 webhook 模式
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "").strip()
+BOT_WEBHOOK_LISTEN = os.getenv("BOT_WEBHOOK_LISTEN", "127.0.0.1")
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8443"))
+BOT_WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "telegram")
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "").strip()
+# direct 模式：Agent 执行线程池大小，以及每个用户同时运行的任务数
+BOT_AGENT_WORKERS = int(os.getenv("BOT_AGENT_WORKERS", "4"))
+BOT_USER_CONCURRENCY = int(os.getenv("BOT_USER_CONCURRENCY", "1"))
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -25,16 +52,16 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def _pending_count() -> int:
-    """当前待处理任务数"""
-    return len(glob.glob(os.path.join(BASE_DIR, ".tg_task_*.txt")))
+async def _pending_count() -> int:
+    """当前待处理任务数（数据库读写放到线程里，不阻塞事件循环）"""
+    return await asyncio.to_thread(task_queue.pending_count)
 
 
 async def _cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看队列状态"""
     if update.effective_user.id not in allowed_users:
         return
-    n = _pending_count()
+    n = await _pending_count()
     await update.message.reply_text(f"📋 待处理任务: {n} 个", parse_mode="Markdown")
 
 
@@ -42,14 +69,8 @@ async def _cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """清空任务队列"""
     if update.effective_user.id not in allowed_users:
         return
-    pattern = os.path.join(BASE_DIR, ".tg_task_*.txt")
-    files = glob.glob(pattern)
-    for f in files:
-        try:
-            os.remove(f)
-        except Exception as e:
-            logger.warning(f"删除失败 {f}: {e}")
-    await update.message.reply_text(f"🗑️ 已清空 {len(files)} 个待处理任务", parse_mode="Markdown")
+    n = await asyncio.to_thread(task_queue.clear)
+    await update.message.reply_text(f"🗑️ 已清空 {n} 个待处理任务", parse_mode="Markdown")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -57,7 +78,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id not in allowed_users:
         return
 
-    n = _pending_count()
+    n = await _pending_count()
     msg = (
         "🤖 **永动机**\n\n"
         "直接发任务即可，我会加入队列。\n"
@@ -81,25 +102,129 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
 
     if data == "status":
-        n = _pending_count()
+        n = await _pending_count()
         await query.edit_message_text(
             f"📋 **队列状态**\n\n待处理任务: {n} 个\n\n直接发消息即可添加新任务。",
             parse_mode="Markdown",
         )
         return
 
-    if data.startswith("approve_"):
-        req_id = data.split("_")[1]
-        file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f".tg_response_{req_id}.txt")
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write("APPROVED")
-        await query.edit_message_text(f"{query.message.text}\n\n✅ **已点选: 允许执行**", parse_mode="Markdown")
-    elif data.startswith("reject_"):
-        req_id = data.split("_")[1]
-        file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f".tg_response_{req_id}.txt")
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write("REJECTED")
-        await query.edit_message_text(f"{query.message.text}\n\n❌ **已点选: 拒绝放行**", parse_mode="Markdown")
+    if data.startswith("approve_") or data.startswith("reject_"):
+        action, req_id = data.split("_", 1)
+        approved = action == "approve"
+        if not await asyncio.to_thread(approvals.resolve, req_id, approved):
+            await query.edit_message_text(f"{query.message.text}\n\n⌛ **请求已过期或已处理**", parse_mode="Markdown")
+            return
+        if approved:
+            await query.edit_message_text(f"{query.message.text}\n\n✅ **已点选: 允许执行**", parse_mode="Markdown")
+        else:
+            await query.edit_message_text(f"{query.message.text}\n\n❌ **已点选: 拒绝放行**", parse_mode="Markdown")
+
+
+# Agent 在独立的有界线程池里运行，不占用默认执行器（数据库操作用的 to_thread）
+_agent_pool = ThreadPoolExecutor(max_workers=max(BOT_AGENT_WORKERS, 1), thread_name_prefix="agent")
+_user_slots: dict[int, asyncio.Semaphore] = {}
+
+
+def _retry_seconds(e: RetryAfter) -> float:
+    delay = e.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+async def _edit(message, text: str) -> tuple[bool, float]:
+    """编辑消息，返回 (是否成功, 需要额外等待的秒数)；网络错误等只记日志，不中断流式回复"""
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        return False, _retry_seconds(e)
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return True, 0.0
+        logger.warning(f"编辑流式消息失败: {e}")
+        return False, 0.0
+    except TelegramError as e:
+        logger.warning(f"编辑流式消息失败: {e}")
+        return False, 0.0
+    return True, 0.0
+
+
+def _render_stream(text: str, status: str) -> str:
+    """流式过程中的消息内容：只保留末尾，超长时截掉开头"""
+    body = text.strip() or "🤔 思考中…"
+    if status:
+        body += f"\n\n{status}"
+    if len(body) > STREAM_MAX_TEXT:
+        body = "…" + body[-(STREAM_MAX_TEXT - 1):]
+    return body
+
+
+async def _stream_reply(update: Update, user_message: str) -> None:
+    """mcp_agent 在线程里流式处理，事件经 asyncio.Queue 送回，节流后编辑同一条消息"""
+    reply = await update.message.reply_text("🤔 思考中…")
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def worker() -> None:
+        try:
+            import mcp_agent  # 在工作线程里导入，首次加载 SDK 不阻塞事件循环
+
+            for event in mcp_agent.process_stream(user_message):
+                loop.call_soon_threadsafe(events.put_nowait, event)
+        except Exception as e:
+            logger.error(f"Agent 处理失败: {e}")
+            loop.call_soon_threadsafe(events.put_nowait, {"type": "done", "text": f"❌ 处理失败: {e}"})
+        finally:
+            loop.call_soon_threadsafe(events.put_nowait, None)
+
+    loop.run_in_executor(_agent_pool, worker)
+
+    text, status, final = "", "", None
+    shown = "🤔 思考中…"
+    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+    while True:
+        try:
+            event = await asyncio.wait_for(events.get(), max(next_edit - time.monotonic(), 0.05))
+        except asyncio.TimeoutError:
+            event = {"type": "tick"}
+        if event is None:
+            break
+        if event["type"] == "text":
+            text += event["text"]
+            status = ""
+        elif event["type"] == "tool_call":
+            status = f"🔧 {event['name']}…"
+        elif event["type"] == "tool_result":
+            text += "\n"
+            status = f"✔️ {event['name']}（{event['chars']} 字符）"
+        elif event["type"] == "done":
+            final = event["text"]
+        rendered = _render_stream(text, status)
+        if rendered != shown and time.monotonic() >= next_edit:
+            _, wait = await _edit(reply, rendered)
+            shown = rendered
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL + wait
+
+    final = final or text.strip() or "（无回复）"
+    chunks = [final[i:i + STREAM_MAX_TEXT] for i in range(0, len(final), STREAM_MAX_TEXT)]
+    delay = max(next_edit - time.monotonic(), 0)
+    edited = False
+    for _ in range(FINAL_EDIT_ATTEMPTS):
+        await asyncio.sleep(delay)
+        edited, wait = await _edit(reply, chunks[0])
+        if edited:
+            break
+        delay = wait or STREAM_EDIT_INTERVAL
+    # 编辑始终失败时，整个回复改为新消息发出
+    for chunk in chunks[1:] if edited else chunks:
+        for _ in range(FINAL_EDIT_ATTEMPTS):
+            try:
+                await update.message.reply_text(chunk)
+                break
+            except RetryAfter as e:
+                await asyncio.sleep(_retry_seconds(e))
+            except TelegramError as e:
+                logger.warning(f"发送回复失败: {e}")
+                await asyncio.sleep(STREAM_EDIT_INTERVAL)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -111,11 +236,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_message:
         return
 
-    try:
-        from middleware import write_task
+    if BOT_AGENT_MODE == "direct":
+        slot = _user_slots.setdefault(user_id, asyncio.Semaphore(max(BOT_USER_CONCURRENCY, 1)))
+        if slot.locked():
+            await update.message.reply_text("⏳ 你还有任务在运行，这条已排队，完成后开始处理。")
+        async with slot:
+            await _stream_reply(update, user_message)
+        return
 
-        task_id = write_task(user_message)
-        n = _pending_count()
+    try:
+        task_id = await asyncio.to_thread(write_task, user_message)
+        n = await _pending_count()
         await update.message.reply_text(
             f"📥 **已加入队列**\n\n"
             f"任务 ID: `{task_id}`\n"
@@ -128,20 +259,45 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ 写入失败: {str(e)}")
 
 
+def _webhook_secret() -> str:
+    """未配置 BOT_WEBHOOK_SECRET 时由 token 派生，重启后保持不变"""
+    if BOT_WEBHOOK_SECRET:
+        return BOT_WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()[:32]
+
+
 def main():
     if not TELEGRAM_TOKEN or not allowed_users:
         logger.error("缺少 TELEGRAM_BOT_TOKEN 或 ALLOWED_USER_IDS 配置。")
         return
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # 处理器并发执行：一个用户的长任务不会挡住其他用户和按钮回调
+    builder = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True)
+    # 与 telegram_client 共用 API 地址，测试时可指向本地假服务器
+    builder = builder.base_url(f"{telegram_client.API_BASE}/bot").base_file_url(f"{telegram_client.API_BASE}/file/bot")
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("status", _cmd_status))
     app.add_handler(CommandHandler("clear", _cmd_clear))
     app.add_handler(CallbackQueryHandler(button_callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    logger.info("永动机 Bot 已启动")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_WEBHOOK_URL:
+        # Telegram 主动推送更新；重启期间未送达的更新由 Telegram 暂存重试，不丢弃
+        url_path = BOT_WEBHOOK_PATH.strip("/")
+        logger.info(f"永动机 Bot 已启动（webhook，监听 {BOT_WEBHOOK_LISTEN}:{BOT_WEBHOOK_PORT}/{url_path}）")
+        app.run_webhook(
+            listen=BOT_WEBHOOK_LISTEN,
+            port=BOT_WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f"{BOT_WEBHOOK_URL.rstrip('/')}/{url_path}",
+            secret_token=_webhook_secret(),
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=False,
+        )
+    else:
+        logger.info("永动机 Bot 已启动")
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
@@ -3,14 +3,23 @@ MCP 模式 Agent：支持 Gemini 或 Claude，工具调用直接返回，无需
 优先使用 GEMINI_API_KEY（你已有），无需 Claude。
 """
 import os
+import time
 import logging
-from typing import Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Iterator
 
 from anthropic import Anthropic
+import unified_diff
+from context_budget import compact_claude, compact_gemini
 from tools import (
     run_command,
     read_file,
+    read_file_range,
     write_file,
+    edit_file,
+    apply_patch,
     list_dir,
     glob_search,
     grep_search,
@@ -30,7 +39,10 @@ CLAUDE_TOOLS = [
         "description": "【agent_cursor】运行终端命令并返回输出。用于执行脚本、测试、git、安装依赖等。",
         "input_schema": {
             "type": "object",
-            "properties": {"command": {"type": "string", "description": "要执行的命令"}},
+            "properties": {
+                "command": {"type": "string", "description": "要执行的命令"},
+                "timeout": {"type": "integer", "description": "超时秒数，默认60；构建、测试等可设更长", "default": 60},
+            },
             "required": ["command"],
         },
     },
@@ -46,9 +58,25 @@ CLAUDE_TOOLS = [
             "required": ["path"],
         },
     },
+    {
+        "name": "read_file_range",
+        "description": "【agent_filesystem】分段读取大文件（日志等）：按行号范围或字节偏移读取一页，不必从头读。",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "文件路径"},
+                "start_line": {"type": "integer", "description": "起始行（从1开始，负数表示倒数第几行）"},
+                "end_line": {"type": "integer", "description": "结束行（含）"},
+                "offset": {"type": "integer", "description": "按字节读取时的起始偏移（负数表示从末尾倒数），与 start_line 二选一"},
+                "length": {"type": "integer", "description": "按字节读取的长度"},
+                "limit": {"type": "integer", "description": "最多返回字符数，默认8000", "default": 8000},
+            },
+            "required": ["path"],
+        },
+    },
     {
         "name": "write_file",
-        "description": "【agent_filesystem】将内容写入文件，若存在则覆盖。",
+        "description": "【agent_filesystem】将内容写入文件，若存在则覆盖。修改已有文件请优先用 edit_file / apply_patch。",
         "input_schema": {
             "type": "object",
             "properties": {
@@ -58,12 +86,39 @@ CLAUDE_TOOLS = [
             "required": ["path", "content"],
         },
     },
+    {
+        "name": "edit_file",
+        "description": "【agent_filesystem】局部修改文件：把 old_string 替换为 new_string，只需给出改动处及少量上下文，不必重写整个文件。old_string 必须唯一。",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "文件路径"},
+                "old_string": {"type": "string", "description": "要替换的原文（须与文件内容完全一致）"},
+                "new_string": {"type": "string", "description": "替换后的内容"},
+                "replace_all": {"type": "boolean", "description": "替换所有出现处", "default": False},
+            },
+            "required": ["path", "old_string", "new_string"],
+        },
+    },
+    {
+        "name": "apply_patch",
+        "description": "【agent_filesystem】应用 unified diff 补丁（可多文件、新建、删除），路径相对于沙箱目录。全部 hunk 对上才写入。",
+        "input_schema": {
+            "type": "object",
+            "properties": {"patch": {"type": "string", "description": "unified diff 文本（--- a/路径 / +++ b/路径 / @@ ... @@）"}},
+            "required": ["patch"],
+        },
+    },
     {
         "name": "list_dir",
         "description": "【agent_filesystem】列出目录下的文件和子目录。类似 ls 命令。",
         "input_schema": {
             "type": "object",
-            "properties": {"path": {"type": "string", "description": "目录路径，默认当前目录", "default": "."}},
+            "properties": {
+                "path": {"type": "string", "description": "目录路径，默认当前目录", "default": "."},
+                "offset": {"type": "integer", "description": "翻页起点（上一页末尾给出）", "default": 0},
+                "limit": {"type": "integer", "description": "每页条数，默认100", "default": 100},
+            },
             "required": [],
         },
     },
@@ -75,6 +130,8 @@ CLAUDE_TOOLS = [
             "properties": {
                 "pattern": {"type": "string", "description": "通配符模式"},
                 "base_dir": {"type": "string", "description": "搜索根目录", "default": "."},
+                "offset": {"type": "integer", "description": "翻页起点（上一页末尾给出）", "default": 0},
+                "limit": {"type": "integer", "description": "每页条数，默认50", "default": 50},
             },
             "required": ["pattern"],
         },
@@ -95,19 +152,32 @@ CLAUDE_TOOLS = [
 ]
 
 
-def _execute_tool(name: str, args: dict[str, Any]) -> str:
-    """执行工具并返回结果。"""
+def _execute_tool(name: str, args: dict[str, Any], task_id: str = "") -> str:
+    """执行工具并返回结果。task_id 传给 run_command，用于输出推送（续约）和按任务取消"""
     try:
         if name == "run_command":
-            return run_command(args["command"])
+            return run_command(args["command"], args.get("timeout"), task_id=task_id)
         if name == "read_file":
             return read_file(args["path"], args.get("limit", 8000))
+        if name == "read_file_range":
+            return read_file_range(
+                args["path"],
+                args.get("start_line", 0),
+                args.get("end_line", 0),
+                args.get("offset"),
+                args.get("length", 0),
+                args.get("limit", 8000),
+            )
         if name == "write_file":
             return write_file(args["path"], args["content"])
+        if name == "edit_file":
+            return edit_file(args["path"], args["old_string"], args["new_string"], args.get("replace_all", False))
+        if name == "apply_patch":
+            return apply_patch(args["patch"])
         if name == "list_dir":
-            return list_dir(args.get("path", "."))
+            return list_dir(args.get("path", "."), args.get("offset", 0), args.get("limit", 100))
         if name == "glob_search":
-            return glob_search(args["pattern"], args.get("base_dir", "."))
+            return glob_search(args["pattern"], args.get("base_dir", "."), args.get("offset", 0), args.get("limit", 50))
         if name == "grep_search":
             return grep_search(
                 args["pattern"],
@@ -121,117 +191,373 @@ def _execute_tool(name: str, args: dict[str, Any]) -> str:
         return f"执行失败: {str(e)}"
 
 
-def process_with_claude(
+# 同一轮的多个工具调用并发执行
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+# 每种工具的并发上限（未列出的只受线程池大小约束）
+TOOL_CONCURRENCY = {"run_command": int(os.getenv("TOOL_RUN_COMMAND_CONCURRENCY", "2"))}
+# 会写文件的工具：改动路径有交集的调用按模型给出的顺序串行
+WRITE_TOOLS = {"write_file", "edit_file", "apply_patch"}
+# 副作用不可知的工具：独占执行，前后的调用都不与它并发
+EXCLUSIVE_TOOLS = {"run_command"}
+
+_tool_pool = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+_tool_semaphores = {name: threading.BoundedSemaphore(max(n, 1)) for name, n in TOOL_CONCURRENCY.items()}
+
+
+def _run_group(calls: list[tuple[str, dict[str, Any]]], task_id: str = "") -> list[str]:
+    """顺序执行一组调用（同一路径的写操作），受每种工具的并发上限约束"""
+    results = []
+    for name, args in calls:
+        with _tool_semaphores.get(name) or nullcontext():
+            results.append(_execute_tool(name, args, task_id))
+    return results
+
+
+def _write_paths(name: str, args: dict[str, Any]) -> frozenset[str] | None:
+    """写操作会改动的路径（补丁含改名的源和目标）；非写操作为空集，无法确定时返回 None"""
+    if name not in WRITE_TOOLS:
+        return frozenset()
+    if args.get("path"):
+        return frozenset({os.path.abspath(os.path.expanduser(str(args["path"])))})
+    if name == "apply_patch":
+        try:
+            file_patches = unified_diff.parse(str(args.get("patch", "")))
+        except Exception:
+            return None
+        return frozenset(
+            os.path.abspath(rel if os.path.isabs(rel) else os.path.join(APPROVED_BASE, rel))
+            for fp in file_patches for rel in (fp.old_path, fp.new_path) if rel
+        )
+    return None
+
+
+def _groups(calls: list[tuple[str, dict[str, Any]]], stage: list[int]) -> list[list[int]]:
+    """
+    把一个阶段的调用分成可并发的组：改动路径有交集的调用（含多文件补丁）合为一组，组内按原顺序串行
+    有调用改动的路径无法确定时，整个阶段串行
+    """
+    groups: list[tuple[set[str], list[int]]] = []
+    for i in stage:
+        paths = _write_paths(*calls[i])
+        if paths is None:
+            return [stage]
+        merged: tuple[set[str], list[int]] = (set(paths), [i])
+        rest = []
+        for group in groups:
+            if group[0] & merged[0]:
+                merged[0].update(group[0])
+                merged[1].extend(group[1])
+            else:
+                rest.append(group)
+        merged[1].sort()
+        groups = rest + [merged]
+    return [idxs for _, idxs in groups]
+
+
+def _stages(calls: list[tuple[str, dict[str, Any]]]) -> list[list[int]]:
+    """
+    按调用顺序切分执行阶段：相邻的只读调用一个阶段，相邻的写操作一个阶段，run_command 单独一个阶段
+    阶段之间严格先后，写操作和命令因此都是屏障：之前的调用看不到它的结果，之后的调用一定看得到
+    """
+    stages: list[list[int]] = []
+    last_kind = None
+    for i, (name, _) in enumerate(calls):
+        kind = "exclusive" if name in EXCLUSIVE_TOOLS else "write" if name in WRITE_TOOLS else "read"
+        if kind == last_kind and kind != "exclusive":
+            stages[-1].append(i)
+        else:
+            stages.append([i])
+        last_kind = kind
+    return stages
+
+
+def execute_tools(calls: list[tuple[str, dict[str, Any]]], task_id: str = "") -> list[str]:
+    """
+    并发执行同一轮的多个工具调用，结果按输入顺序返回
+    按 _stages 分阶段依次执行；阶段内按 _groups 分组，各组并发，组内串行
+    """
+    if len(calls) <= 1:
+        return _run_group(calls, task_id)
+    results: list[str] = [""] * len(calls)
+    for stage in _stages(calls):
+        groups = _groups(calls, stage)
+        if len(groups) == 1:
+            idxs = groups[0]
+            for i, result in zip(idxs, _run_group([calls[i] for i in idxs], task_id)):
+                results[i] = result
+            continue
+        futures = [_tool_pool.submit(_run_group, [calls[i] for i in idxs], task_id) for idxs in groups]
+        for idxs, future in zip(groups, futures):
+            for i, result in zip(idxs, future.result()):
+                results[i] = result
+    return results
+
+
+# 开启 provider 端 prompt 缓存（固定的 system/tools 前缀 + 逐轮增长的对话前缀）
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "1") == "1"
+# Gemini 显式上下文缓存（system + tools），内容太短时 API 会拒绝，自动回退
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "3600"))
+
+CLAUDE_SYSTEM_PROMPT = (
+    "你是运行在用户本地的 AI 编程助手。你可以通过工具执行命令、读写文件来完成任务。"
+    "请用中文回复。路径请使用绝对路径或相对于工作目录的路径。"
+    f"允许操作的基础目录: {APPROVED_BASE}"
+)
+GEMINI_SYSTEM_PROMPT = f"你是本地 AI 编程助手。用工具执行命令、读写文件。用中文回复。沙箱目录: {APPROVED_BASE}"
+
+_clients_lock = threading.Lock()
+_anthropic_clients: dict[str, Anthropic] = {}
+_gemini_clients: dict[str, Any] = {}
+_gemini_configs: dict[tuple[str, str], tuple[Any, float]] = {}
+
+
+def _anthropic_client(api_key: str) -> Anthropic:
+    """进程内复用 Anthropic 客户端（底层 httpx 连接池保持 keep-alive）"""
+    with _clients_lock:
+        client = _anthropic_clients.get(api_key)
+        if client is None:
+            client = _anthropic_clients[api_key] = Anthropic(api_key=api_key)
+        return client
+
+
+def _claude_system() -> str | list[dict[str, Any]]:
+    """system 块带 cache_control：缓存前缀覆盖 tools + system"""
+    if not PROMPT_CACHE:
+        return CLAUDE_SYSTEM_PROMPT
+    return [{"type": "text", "text": CLAUDE_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+
+def _with_cache_breakpoint(messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    在最后一条消息的最后一个块上打缓存断点，下一轮请求即可命中已增长的对话前缀
+    只拷贝最后一条消息，不改动 messages 本身（断点始终只有一个，不会累积）
+    """
+    if not PROMPT_CACHE or not messages:
+        return messages
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        blocks: list[Any] = [{"type": "text", "text": content}]
+    else:
+        blocks = list(content)
+    if not blocks or not isinstance(blocks[-1], dict):
+        return messages
+    blocks[-1] = {**blocks[-1], "cache_control": {"type": "ephemeral"}}
+    return messages[:-1] + [{**last, "content": blocks}]
+
+
+def _final_text(events: Iterator[dict[str, Any]]) -> str:
+    """消费事件流，返回 done 事件里的最终文本"""
+    text = ""
+    for event in events:
+        if event["type"] == "done":
+            text = event["text"]
+    return text
+
+
+def stream_with_claude(
     message: str,
     api_key: str,
     model: str = "claude-sonnet-4-20250514",
     max_turns: int = 10,
-) -> str:
+    task_id: str = "",
+) -> Iterator[dict[str, Any]]:
     """
-    使用 Claude API + 工具调用处理消息，直接返回最终文本，无需剪贴板。
+    流式版 process_with_claude，逐步产出事件：
+      {"type": "text", "text": 增量文本}
+      {"type": "tool_call", "name": 工具名, "args": 参数}
+      {"type": "tool_result", "name": 工具名, "chars": 结果长度}
+      {"type": "done", "text": 最终回复}
     """
-    client = Anthropic(api_key=api_key)
+    client = _anthropic_client(api_key)
     messages: list[dict[str, Any]] = [{"role": "user", "content": message}]
 
-    system_prompt = (
-        "你是运行在用户本地的 AI 编程助手。你可以通过工具执行命令、读写文件来完成任务。"
-        "请用中文回复。路径请使用绝对路径或相对于工作目录的路径。"
-        f"允许操作的基础目录: {APPROVED_BASE}"
-    )
-
     for _ in range(max_turns):
-        response = client.messages.create(
+        compact_claude(messages)
+        with client.messages.stream(
             model=model,
             max_tokens=4096,
-            system=system_prompt,
+            system=_claude_system(),
             tools=CLAUDE_TOOLS,
-            messages=messages,
-        )
+            messages=_with_cache_breakpoint(messages),
+        ) as stream:
+            for text in stream.text_stream:
+                yield {"type": "text", "text": text}
+            response = stream.get_final_message()
 
         # 无 tool_use 则返回最终文本
-        if response.stop_reason == "end_turn":
-            for block in reversed(response.content):
-                if block.type == "text":
-                    return block.text
-            return "（无文本回复）"
+        blocks = [block for block in response.content if block.type == "tool_use"]
+        if response.stop_reason == "end_turn" or not blocks:
+            final = next((b.text for b in reversed(response.content) if b.type == "text"), "")
+            yield {"type": "done", "text": final or "（无文本回复）"}
+            return
 
-        # 处理 tool_use
+        # 处理 tool_use：同一轮的调用并发执行，结果按 tool_use_id 对应
+        calls = [(block.name, dict(block.input or {})) for block in blocks]
+        for name, args in calls:
+            yield {"type": "tool_call", "name": name, "args": args}
+        results = execute_tools(calls, task_id)
         tool_results: list[dict[str, Any]] = []
-        for block in response.content:
-            if block.type == "tool_use":
-                result = _execute_tool(block.name, block.input)
-                tool_results.append(
-                    {
-                        "type": "tool_result",
-                        "tool_use_id": block.id,
-                        "content": result,
-                    }
-                )
-                logger.info(f"工具调用: {block.name} -> {len(result)} 字符")
+        for block, result in zip(blocks, results):
+            tool_results.append(
+                {
+                    "type": "tool_result",
+                    "tool_use_id": block.id,
+                    "content": result,
+                }
+            )
+            logger.info(f"工具调用: {block.name} -> {len(result)} 字符")
+            yield {"type": "tool_result", "name": block.name, "chars": len(result)}
 
         # 将 assistant 回复和 tool_result 加入对话
         messages.append({"role": "assistant", "content": response.content})
         messages.append({"role": "user", "content": tool_results})
 
-    return "任务暂停：工具调用轮次过多。"
+    yield {"type": "done", "text": "任务暂停：工具调用轮次过多。"}
+
+
+def process_with_claude(
+    message: str,
+    api_key: str,
+    model: str = "claude-sonnet-4-20250514",
+    max_turns: int = 10,
+    task_id: str = "",
+) -> str:
+    """
+    使用 Claude API + 工具调用处理消息，直接返回最终文本，无需剪贴板。
+    """
+    return _final_text(stream_with_claude(message, api_key, model=model, max_turns=max_turns, task_id=task_id))
 
 
 # ============ Gemini 实现（优先，你已有 GEMINI_API_KEY）============
 GEMINI_TOOL_DECLARATIONS = [
-    {"name": "run_command", "description": "运行终端命令", "parameters": {"type": "object", "properties": {"command": {"type": "string"}}, "required": ["command"]}},
+    {"name": "run_command", "description": "运行终端命令", "parameters": {"type": "object", "properties": {"command": {"type": "string"}, "timeout": {"type": "integer"}}, "required": ["command"]}},
     {"name": "read_file", "description": "读取文件内容", "parameters": {"type": "object", "properties": {"path": {"type": "string"}, "limit": {"type": "integer"}}, "required": ["path"]}},
-    {"name": "write_file", "description": "写入文件", "parameters": {"type": "object", "properties": {"path": {"type": "string"}, "content": {"type": "string"}}, "required": ["path", "content"]}},
-    {"name": "list_dir", "description": "列出目录", "parameters": {"type": "object", "properties": {"path": {"type": "string"}}}},
-    {"name": "glob_search", "description": "通配符搜索文件", "parameters": {"type": "object", "properties": {"pattern": {"type": "string"}, "base_dir": {"type": "string"}}, "required": ["pattern"]}},
+    {"name": "read_file_range", "description": "分段读取大文件：按行号范围（start_line 从1开始，负数为倒数）或字节偏移（offset/length）读取一页", "parameters": {"type": "object", "properties": {"path": {"type": "string"}, "start_line": {"type": "integer"}, "end_line": {"type": "integer"}, "offset": {"type": "integer"}, "length": {"type": "integer"}, "limit": {"type": "integer"}}, "required": ["path"]}},
+    {"name": "write_file", "description": "写入文件（整体覆盖；修改已有文件优先用 edit_file）", "parameters": {"type": "object", "properties": {"path": {"type": "string"}, "content": {"type": "string"}}, "required": ["path", "content"]}},
+    {"name": "edit_file", "description": "局部修改文件：把唯一出现的 old_string 替换为 new_string，不必重写整个文件", "parameters": {"type": "object", "properties": {"path": {"type": "string"}, "old_string": {"type": "string"}, "new_string": {"type": "string"}, "replace_all": {"type": "boolean"}}, "required": ["path", "old_string", "new_string"]}},
+    {"name": "apply_patch", "description": "应用 unified diff 补丁（可多文件），路径相对于沙箱目录", "parameters": {"type": "object", "properties": {"patch": {"type": "string"}}, "required": ["patch"]}},
+    {"name": "list_dir", "description": "列出目录（含大小、修改时间，offset 翻页）", "parameters": {"type": "object", "properties": {"path": {"type": "string"}, "offset": {"type": "integer"}, "limit": {"type": "integer"}}}},
+    {"name": "glob_search", "description": "通配符搜索文件（offset 翻页）", "parameters": {"type": "object", "properties": {"pattern": {"type": "string"}, "base_dir": {"type": "string"}, "offset": {"type": "integer"}, "limit": {"type": "integer"}}, "required": ["pattern"]}},
     {"name": "grep_search", "description": "在文件中搜索文本", "parameters": {"type": "object", "properties": {"pattern": {"type": "string"}, "path": {"type": "string"}, "max_results": {"type": "integer"}}, "required": ["pattern", "path"]}},
 ]
 
 
-def process_with_gemini(message: str, api_key: str, model: str = "gemini-2.0-flash", max_turns: int = 10) -> str:
-    """使用 Gemini API，无需 Claude。"""
+def _gemini_client(api_key: str):
+    """进程内复用 genai.Client"""
     from google import genai
+
+    with _clients_lock:
+        client = _gemini_clients.get(api_key)
+        if client is None:
+            client = _gemini_clients[api_key] = genai.Client(api_key=api_key)
+        return client
+
+
+def _gemini_config(client, api_key: str, model: str):
+    """
+    每个 (api_key, model) 只构建一次 tools + GenerateContentConfig
+    开启 GEMINI_CONTEXT_CACHE 时把 system + tools 放进显式缓存，过期前重建
+    """
     from google.genai import types
 
-    client = genai.Client(api_key=api_key)
+    key = (api_key, model)
+    with _clients_lock:
+        cached = _gemini_configs.get(key)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
     tools = [types.Tool(function_declarations=GEMINI_TOOL_DECLARATIONS)]
-    config = types.GenerateContentConfig(
-        system_instruction=f"你是本地 AI 编程助手。用工具执行命令、读写文件。用中文回复。沙箱目录: {APPROVED_BASE}",
-        tools=tools,
-        temperature=0.7,
-    )
+    config = None
+    expires = float("inf")
+    if GEMINI_CONTEXT_CACHE:
+        try:
+            cache = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=GEMINI_SYSTEM_PROMPT,
+                    tools=tools,
+                    ttl=f"{GEMINI_CACHE_TTL}s",
+                ),
+            )
+            config = types.GenerateContentConfig(cached_content=cache.name, temperature=0.7)
+            expires = time.time() + GEMINI_CACHE_TTL * 0.9
+        except Exception as e:
+            logger.info(f"Gemini 上下文缓存不可用，回退普通请求: {e}")
+    if config is None:
+        config = types.GenerateContentConfig(system_instruction=GEMINI_SYSTEM_PROMPT, tools=tools, temperature=0.7)
+    with _clients_lock:
+        _gemini_configs[key] = (config, expires)
+    return config
+
+
+def stream_with_gemini(
+    message: str,
+    api_key: str,
+    model: str = "gemini-2.0-flash",
+    max_turns: int = 10,
+    task_id: str = "",
+) -> Iterator[dict[str, Any]]:
+    """流式版 process_with_gemini，事件格式同 stream_with_claude"""
+    from google.genai import types
+
+    client = _gemini_client(api_key)
+    config = _gemini_config(client, api_key, model)
     history = [types.Content(role="user", parts=[types.Part.from_text(text=message)])]
 
     for _ in range(max_turns):
-        response = client.models.generate_content(model=model, contents=history, config=config)
-        parts = response.candidates[0].content.parts if response.candidates else []
-        has_tool_call = False
-
-        for part in parts:
-            if hasattr(part, "function_call") and part.function_call:
-                fc = part.function_call
-                name = fc.name
-                args = dict(fc.args) if fc.args else {}
-                result = _execute_tool(name, args)
-                logger.info(f"工具: {name} -> {len(result)} 字符")
-                history.append(types.Content(role="model", parts=[part]))
-                history.append(types.Content(role="user", parts=[types.Part.from_function_response(name=name, response={"result": result})]))
-                has_tool_call = True
-                break
-
-        if not has_tool_call:
-            text = response.text or ""
-            return text.strip() or "（无回复）"
-
-    return "任务暂停：工具调用轮次过多。"
-
-
-def process(message: str) -> str:
-    """自动选择：GEMINI_API_KEY 优先，否则 ANTHROPIC_API_KEY"""
+        compact_gemini(history)
+        text = ""
+        call_parts = []
+        for chunk in client.models.generate_content_stream(model=model, contents=history, config=config):
+            content = chunk.candidates[0].content if chunk.candidates else None
+            for part in (content.parts if content else None) or []:
+                if getattr(part, "function_call", None):
+                    call_parts.append(part)
+                elif getattr(part, "text", None) and not getattr(part, "thought", False):
+                    text += part.text
+                    yield {"type": "text", "text": part.text}
+
+        if not call_parts:
+            yield {"type": "done", "text": text.strip() or "（无回复）"}
+            return
+
+        # 一轮里的所有 function_call 并发执行，结果放进同一个 Content 返回
+        calls = [(p.function_call.name, dict(p.function_call.args) if p.function_call.args else {}) for p in call_parts]
+        for name, args in calls:
+            yield {"type": "tool_call", "name": name, "args": args}
+        results = execute_tools(calls, task_id)
+        model_parts = ([types.Part.from_text(text=text)] if text else []) + call_parts
+        history.append(types.Content(role="model", parts=model_parts))
+        history.append(types.Content(role="user", parts=[
+            types.Part.from_function_response(name=name, response={"result": result})
+            for (name, _), result in zip(calls, results)
+        ]))
+        for (name, _), result in zip(calls, results):
+            logger.info(f"工具: {name} -> {len(result)} 字符")
+            yield {"type": "tool_result", "name": name, "chars": len(result)}
+
+    yield {"type": "done", "text": "任务暂停：工具调用轮次过多。"}
+
+
+def process_with_gemini(message: str, api_key: str, model: str = "gemini-2.0-flash", max_turns: int = 10, task_id: str = "") -> str:
+    """使用 Gemini API，无需 Claude。history 只追加，前缀稳定以便命中隐式缓存。"""
+    return _final_text(stream_with_gemini(message, api_key, model=model, max_turns=max_turns, task_id=task_id))
+
+
+def process_stream(message: str, task_id: str = "") -> Iterator[dict[str, Any]]:
+    """流式版 process：自动选择模型，逐步产出文本增量与工具调用事件。task_id 为队列任务 id（直接对话时为空）"""
     gemini_key = os.environ.get("GEMINI_API_KEY", "").strip()
     anthropic_key = os.environ.get("ANTHROPIC_API_KEY", "").strip()
 
     if gemini_key:
-        return process_with_gemini(message, gemini_key)
+        return stream_with_gemini(message, gemini_key, task_id=task_id)
     if anthropic_key:
-        return process_with_claude(message, anthropic_key)
+        return stream_with_claude(message, anthropic_key, task_id=task_id)
     raise ValueError("请在 .env 中配置 GEMINI_API_KEY 或 ANTHROPIC_API_KEY")
+
+
+def process(message: str, task_id: str = "") -> str:
+    """自动选择：GEMINI_API_KEY 优先，否则 ANTHROPIC_API_KEY"""
+    return _final_text(process_stream(message, task_id))
@@ -1,11 +1,16 @@
 """
 MCP 服务器：暴露中间层工具给 Cursor Agent
-- wait_for_task: 阻塞等待 Bot 写入的任务
+- wait_for_task: 等待 Bot 写入的任务
 - request_approval: 请求远程放权
 - report_done: 汇报完成
+
+工具都是协程：等待任务/放权不占线程，客户端取消请求时立即停止等待；
+多个会话同时等待时按先来先得轮流领取任务。会阻塞的汇报调用放到 asyncio 默认线程池执行，
+服务器线程数与等待中的会话数无关。
 """
 import os
 import sys
+import asyncio
 
 # 确保从项目目录加载
 _DIR = os.path.dirname(os.path.abspath(__file__))
@@ -18,40 +23,40 @@ mcp = FastMCP("middleware", instructions="Telegram 中间层：任务队列、
 
 
 @mcp.tool()
-def wait_for_task(poll_interval_sec: float = 5, timeout_sec: int = 0) -> str:
+async def wait_for_task(poll_interval_sec: float = 5, timeout_sec: int = 0) -> str:
     """
-    阻塞等待新任务。用户通过 Telegram 发消息后，Bot 会写入任务文件。
-    timeout_sec=0 表示无限等待。返回任务内容。
+    等待新任务。用户通过 Telegram 发消息后，Bot 会写入任务队列并立即唤醒这里。
+    timeout_sec=0 表示无限等待。返回任务内容，超时返回空字符串。
     """
-    from middleware import wait_for_task as _wait_task
+    from middleware import wait_for_task_async as _wait_task
 
-    return _wait_task(poll_interval_sec=poll_interval_sec, timeout_sec=timeout_sec)
+    return await _wait_task(poll_interval_sec=poll_interval_sec, timeout_sec=timeout_sec)
 
 
 @mcp.tool()
-def request_approval(question: str, task_id: str = "", timeout_sec: int = 3600) -> bool:
+async def request_approval(question: str, task_id: str = "", timeout_sec: int = 3600) -> bool:
     """
-    请求远程放权。阻塞直到用户在 Telegram 点击按钮。返回 True=允许，False=拒绝或超时。
+    请求远程放权。等待直到用户在 Telegram 点击按钮。返回 True=允许，False=拒绝或超时。
     """
-    from middleware import request_approval as _ask
+    from middleware import request_approval_async as _ask
 
-    return _ask(question=question, task_id=task_id, timeout_sec=timeout_sec)
+    return await _ask(question=question, task_id=task_id, timeout_sec=timeout_sec)
 
 
 @mcp.tool()
-def report_done(message: str, task_id: str = "") -> bool:
-    """任务完成，推送到用户手机"""
+async def report_done(message: str, task_id: str = "", lease: str = "") -> bool:
+    """任务完成，推送到用户手机。lease 填触发消息里给出的租约令牌"""
     from middleware import report_done as _report
 
-    return _report(message=message, task_id=task_id)
+    return await asyncio.to_thread(_report, message=message, task_id=task_id, lease=lease)
 
 
 @mcp.tool()
-def report_progress(step: str, message: str, task_id: str = "") -> bool:
-    """汇报进度给远程用户"""
+async def report_progress(step: str, message: str, task_id: str = "", lease: str = "") -> bool:
+    """汇报进度给远程用户，同时为该任务的租约续约（心跳）。lease 填触发消息里给出的租约令牌"""
     from middleware import report as _report
 
-    return _report(step=step, message=message, task_id=task_id)
+    return await asyncio.to_thread(_report, step=step, message=message, task_id=task_id, lease=lease)
 
 
 if __name__ == "__main__":
@@ -7,97 +7,255 @@
 """
 import os
 import time
-import uuid
+import asyncio
 import logging
+from collections import deque
+from concurrent.futures import Future
 from dotenv import load_dotenv
 
+import approvals
+import notify
+import task_queue
+import send_queue
+import status_card
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ALLOWED_IDS = [x.strip() for x in os.getenv("ALLOWED_USER_IDS", "").split(",") if x.strip()]
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 等待发送结果的上限（含限流重试）
+SEND_WAIT_TIMEOUT = 60
+# 开启后进度汇报入队即返回（总是返回 True，不反映送达结果），同一任务排队中的汇报合并成一条
+REPORT_COALESCE = os.getenv("REPORT_COALESCE", "0") == "1"
+# 后台模式：report_done 也入队即返回，不等待送达
+REPORT_BACKGROUND = os.getenv("REPORT_BACKGROUND", "0") == "1"
+# 状态卡片模式：每个任务一条消息，进度原地编辑
+STATUS_CARD = os.getenv("STATUS_CARD", "0") == "1"
+
+
+def deliver(
+    text: str,
+    parse_mode: str = "Markdown",
+    header: str = "",
+    coalesce_key: str | None = None,
+) -> dict[str, Future]:
+    """
+    经发送队列并发推送给所有 ALLOWED_USER_IDS（遵守限流，429 自动重试）
+    返回 {chat_id: Future}，各 chat 独立成功/失败
+    coalesce_key: 相同 key 且仍在排队的消息合并为一条
+    """
+    return {
+        chat_id: send_queue.submit(chat_id, text, parse_mode=parse_mode, header=header, coalesce_key=coalesce_key, token=TOKEN)
+        for chat_id in ALLOWED_IDS
+    }
 
 
-def _send(text: str, parse_mode: str = "Markdown") -> bool:
-    """发送消息到 Telegram"""
+def _send(
+    text: str,
+    parse_mode: str = "Markdown",
+    header: str = "",
+    coalesce_key: str | None = None,
+    wait: bool = True,
+) -> bool:
+    """
+    发送到所有 chat。wait=True 时等待全部结果（耗时取决于最慢的 chat），
+    wait=False 时入队即返回（后台发送，失败只记日志）
+    """
     if not TOKEN or not ALLOWED_IDS:
         logger.warning("未配置 TELEGRAM_BOT_TOKEN 或 ALLOWED_USER_IDS")
         return False
-    try:
-        import requests
-        for chat_id in ALLOWED_IDS:
-            requests.post(
-                f"https://api.telegram.org/bot{TOKEN}/sendMessage",
-                json={"chat_id": chat_id, "text": text[:4000], "parse_mode": parse_mode},
-                timeout=10,
-            )
+    results = deliver(text, parse_mode=parse_mode, header=header, coalesce_key=coalesce_key)
+    if not wait:
         return True
-    except Exception as e:
-        logger.error(f"发送失败: {e}")
-        return False
+    return all(_wait_results(results).values())
 
 
-TASK_DIR = BASE_DIR
-TASK_PREFIX = ".tg_task_"
+def _wait_results(futures: dict[str, Future]) -> dict[str, bool]:
+    """等待各 chat 的发送结果（共用一个截止时间），返回 {chat_id: 是否成功}"""
+    deadline = time.time() + SEND_WAIT_TIMEOUT
+    results = {}
+    for chat_id, fut in futures.items():
+        try:
+            fut.result(timeout=max(deadline - time.time(), 0))
+            results[chat_id] = True
+        except Exception as e:
+            logger.error(f"发送失败 {chat_id}: {e}")
+            results[chat_id] = False
+    return results
 
 
 def wait_for_task(poll_interval_sec: float = 5, timeout_sec: int = 0) -> str:
     """
-    阻塞等待新任务。Bot 收到用户消息时会写入 .tg_task_xxx.txt
+    阻塞等待新任务。Bot 收到用户消息时会写入任务队列并立即唤醒这里
+    poll_interval_sec 仅作兜底轮询间隔
     timeout_sec=0 表示无限等待
     返回任务内容，无任务时返回空字符串（仅在超时情况下）
     """
-    import glob
     deadline = (time.time() + timeout_sec) if timeout_sec > 0 else None
-    pattern = os.path.join(TASK_DIR, f"{TASK_PREFIX}*.txt")
-    while True:
-        files = sorted(glob.glob(pattern))
-        if files:
+    with notify.Doorbell(notify.TASK_CHANNEL) as bell:
+        while True:
             try:
-                with open(files[0], "r", encoding="utf-8") as f:
-                    content = f.read()
-                os.remove(files[0])
-                return content.strip()
+                task = task_queue.claim()
+                if task:
+                    return task[1].strip()
             except Exception as e:
-                logger.warning(f"读取任务文件失败: {e}")
-        if deadline and time.time() >= deadline:
-            return ""
-        time.sleep(poll_interval_sec)
-
-
-def report_done(message: str, task_id: str = "") -> bool:
-    """任务完成，推送到用户手机"""
-    prefix = "✅ **【任务完成】**" + (f" `{task_id}`" if task_id else "")
-    text = f"{prefix}\n\n{message}"
-    ok = _send(text)
-    # 守护脚本模式：写入完成信号，移除 Agent 忙标记
-    waiting = os.path.join(BASE_DIR, ".daemon_waiting")
-    done = os.path.join(BASE_DIR, ".daemon_task_done")
-    busy = os.path.join(BASE_DIR, ".agent_busy")
-    if os.path.exists(waiting):
+                logger.warning(f"读取任务失败: {e}")
+            wait = poll_interval_sec
+            if deadline:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return ""
+            bell.wait(wait)
+
+
+class TaskDispatcher:
+    """
+    事件循环内的任务分发：所有异步等待方共用一个 AsyncDoorbell 和一个领取循环
+    - 等待方按到达顺序排队（FIFO），每领取到一个任务交给队首等待方，公平轮转
+    - 等待方被取消或超时即出队；已交付但还没来得及返回的任务转交下一位，没人等就放回队首
+    - 等待方再多也只有一个协程在领取，数据库操作走 asyncio 默认线程池，线程数恒定
+    """
+
+    def __init__(self):
+        self._waiters: deque[tuple[asyncio.Future, float]] = deque()
+        self._bell: notify.AsyncDoorbell | None = None
+        self._runner: asyncio.Task | None = None
+        self._background: set[asyncio.Task] = set()
+
+    async def wait(self, poll_interval_sec: float = 5, timeout_sec: float = 0) -> tuple[str, str] | None:
+        """排队等待下一个任务，返回 (task_id, content)；timeout_sec>0 且超时返回 None"""
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        waiter = (fut, max(poll_interval_sec, 0.1))
+        self._waiters.append(waiter)
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+        elif self._bell is not None:
+            self._bell.poke()
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout_sec if timeout_sec > 0 else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if fut.done():
+                # 超时/取消的同时恰好交付了任务：转交出去，不能丢
+                self._hand_back(fut.result())
+            else:
+                fut.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return None
+
+    def _hand_back(self, task: tuple[str, str]) -> None:
+        """把已领取的任务交给下一位等待方，没有就放回队首并唤醒其他进程"""
+        if self._deliver(task):
+            return
+        job = asyncio.create_task(self._unclaim(task))
+        self._background.add(job)
+        job.add_done_callback(self._background.discard)
+
+    @staticmethod
+    async def _unclaim(task: tuple[str, str]) -> None:
         try:
-            with open(done, "w") as f:
-                f.write("")
-        except Exception:
-            pass
+            await asyncio.to_thread(task_queue.unclaim, *task)
+            notify.ring(notify.TASK_CHANNEL)
+        except Exception as e:
+            logger.error(f"任务 {task[0]} 放回队列失败: {e}")
+
+    def _deliver(self, task: tuple[str, str]) -> bool:
+        while self._waiters:
+            fut, _ = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(task)
+                return True
+        return False
+
+    async def _run(self) -> None:
+        try:
+            self._bell = await notify.AsyncDoorbell.open(notify.TASK_CHANNEL)
+        except OSError as e:
+            logger.warning(f"创建唤醒端口失败，退回轮询: {e}")
+        try:
+            while self._waiters:
+                try:
+                    task = await asyncio.to_thread(task_queue.claim)
+                except Exception as e:
+                    logger.warning(f"读取任务失败: {e}")
+                    task = None
+                if task is not None:
+                    self._hand_back(task)
+                    continue
+                if not self._waiters:
+                    break
+                interval = min(interval for _, interval in self._waiters)
+                if self._bell is not None:
+                    await self._bell.wait(interval)
+                else:
+                    await asyncio.sleep(interval)
+        finally:
+            # 先让出位置：关闭期间到达的等待方会启动新的领取循环
+            self._runner = None
+            bell, self._bell = self._bell, None
+            if bell is not None:
+                await bell.close()
+
+
+_dispatcher: TaskDispatcher | None = None
+
+
+async def wait_for_task_async(poll_interval_sec: float = 5, timeout_sec: int = 0) -> str:
+    """
+    wait_for_task 的异步版本：不占线程，协程取消即停止等待
+    同一进程内的多个等待方按先来先得轮流领取任务
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = TaskDispatcher()
+    task = await _dispatcher.wait(poll_interval_sec, timeout_sec)
+    return task[1].strip() if task else ""
+
+
+def report_done(message: str, task_id: str = "", lease: str = "") -> bool:
+    """任务完成，推送到用户手机；lease 为领取任务时分配的租约令牌，带上时只释放这一次领取"""
+    card_futures = status_card.finish(task_id, message) if STATUS_CARD else None
+    if card_futures is not None:
+        ok = REPORT_BACKGROUND or all(_wait_results(card_futures).values())
+    else:
+        prefix = "✅ **【任务完成】**" + (f" `{task_id}`" if task_id else "")
+        text = f"{prefix}\n\n{message}"
+        ok = _send(text, wait=not REPORT_BACKGROUND)
+    # 守护脚本模式：按 task_id 释放对应槽位，并唤醒 daemon
     try:
-        if os.path.exists(busy):
-            os.remove(busy)
-    except Exception:
-        pass
+        if task_queue.complete(task_id, token=lease):
+            notify.ring(notify.DONE_CHANNEL)
+    except Exception as e:
+        logger.warning(f"标记任务完成失败: {e}")
     return ok
 
 
-def report(step: str, message: str, task_id: str = "") -> bool:
+def report(step: str, message: str, task_id: str = "", lease: str = "") -> bool:
     """
     汇报进度给远程用户
     step: 步骤标识，如 "1/5"、"分析完成"
     message: 详细内容
+    同时作为心跳，为该任务续约（带 lease 时只续约这一次领取）
     """
+    try:
+        task_queue.renew(task_id, token=lease)
+    except Exception as e:
+        logger.warning(f"任务续约失败: {e}")
+    if STATUS_CARD:
+        if not TOKEN or not ALLOWED_IDS:
+            logger.warning("未配置 TELEGRAM_BOT_TOKEN 或 ALLOWED_USER_IDS")
+            return False
+        status_card.update(task_id, step, message, ALLOWED_IDS, token=TOKEN)
+        return True
     prefix = f"📋 **【进度汇报】**" + (f" `{task_id}`" if task_id else "")
-    text = f"{prefix}\n\n**{step}**\n\n{message}"
-    return _send(text)
+    body = f"**{step}**\n\n{message}"
+    if REPORT_COALESCE:
+        return _send(body, header=prefix, coalesce_key=f"progress:{task_id}", wait=False)
+    return _send(body, header=prefix)
 
 
 def request_approval(question: str, task_id: str = "", timeout_sec: int = 3600) -> bool:
@@ -109,10 +267,41 @@ def request_approval(question: str, task_id: str = "", timeout_sec: int = 3600)
         logger.warning("未配置 Telegram")
         return False
 
-    import requests
-    req_id = str(uuid.uuid4())[:8]
-    signal_file = os.path.join(BASE_DIR, f".tg_response_{req_id}.txt")
+    req_id = approvals.create(timeout_sec)
+    text, keyboard = _approval_message(question, task_id, req_id)
+    try:
+        send_queue.submit(ALLOWED_IDS[0], text, reply_markup=keyboard, token=TOKEN).result(timeout=SEND_WAIT_TIMEOUT)
+    except Exception as e:
+        logger.error(f"发送放权请求失败: {e}")
+        approvals.cancel(req_id)
+        return False
+
+    return approvals.wait(req_id, timeout_sec)
+
+
+async def request_approval_async(question: str, task_id: str = "", timeout_sec: int = 3600) -> bool:
+    """request_approval 的异步版本：不占线程；协程被取消时撤销请求，按钮随之失效"""
+    if not TOKEN or not ALLOWED_IDS:
+        logger.warning("未配置 Telegram")
+        return False
+
+    req_id = await asyncio.to_thread(approvals.create, timeout_sec)
+    text, keyboard = _approval_message(question, task_id, req_id)
+    try:
+        fut = send_queue.submit(ALLOWED_IDS[0], text, reply_markup=keyboard, token=TOKEN)
+        await asyncio.wait_for(asyncio.wrap_future(fut), SEND_WAIT_TIMEOUT)
+    except asyncio.CancelledError:
+        approvals.cancel(req_id)
+        raise
+    except Exception as e:
+        logger.error(f"发送放权请求失败: {e}")
+        approvals.cancel(req_id)
+        return False
+
+    return await approvals.wait_async(req_id, timeout_sec)
 
+
+def _approval_message(question: str, task_id: str, req_id: str) -> tuple[str, dict]:
     prefix = "⚠️ **【请求放权】**" + (f" `{task_id}`" if task_id else "")
     text = f"{prefix}\n\n{question}"
     keyboard = {
@@ -121,36 +310,11 @@ def request_approval(question: str, task_id: str = "", timeout_sec: int = 3600)
             {"text": "❌ 拒绝", "callback_data": f"reject_{req_id}"},
         ]]
     }
-    try:
-        r = requests.post(
-            f"https://api.telegram.org/bot{TOKEN}/sendMessage",
-            json={"chat_id": ALLOWED_IDS[0], "text": text, "parse_mode": "Markdown", "reply_markup": keyboard},
-            timeout=10,
-        )
-        r.raise_for_status()
-    except Exception as e:
-        logger.error(f"发送放权请求失败: {e}")
-        return False
-
-    deadline = time.time() + timeout_sec
-    while time.time() < deadline:
-        if os.path.exists(signal_file):
-            try:
-                with open(signal_file, "r", encoding="utf-8") as f:
-                    verdict = f.read().strip()
-                os.remove(signal_file)
-                return verdict == "APPROVED"
-            except Exception:
-                pass
-        time.sleep(1)
-    logger.warning("放权请求超时")
-    return False
+    return text, keyboard
 
 
 def write_task(content: str) -> str:
-    """写入新任务文件，供 wait_for_task 读取。返回 task_id"""
-    task_id = str(uuid.uuid4())[:8]
-    path = os.path.join(TASK_DIR, f"{TASK_PREFIX}{task_id}.txt")
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(content)
-    return task_id
\ No newline at end of file
+    """写入任务队列并唤醒等待方，供 wait_for_task 读取。返回 task_id"""
+    task_id = task_queue.enqueue(content)
+    notify.ring(notify.TASK_CHANNEL)
+    return task_id
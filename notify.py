@@ -0,0 +1,212 @@
+"""
+跨进程唤醒：替代 sleep 轮询
+
+等待方：Doorbell(channel, ...) 在 127.0.0.1 上绑定一个 UDP 端口，登记到队列数据库
+写入方：ring(channel) 向该频道所有登记的端口各发一个数据报
+
+数据报在 socket 缓冲区里排队，所以「先登记 → 检查队列 → 等待」不会丢唤醒。
+跨平台（Windows/Linux/macOS 均可），等待时不占 CPU；轮询间隔只作兜底。
+AsyncDoorbell 是事件循环版本：不占线程，等待可随协程取消。
+"""
+import os
+import time
+import asyncio
+import socket
+import select
+import logging
+
+import task_queue
+
+logger = logging.getLogger(__name__)
+
+TASK_CHANNEL = "task"
+DONE_CHANNEL = "done"
+
+# 等待方每隔这么久刷新一次登记；超过 STALE_SEC 未刷新的登记视为失效
+REFRESH_SEC = 30
+STALE_SEC = 120
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listeners (
+    channel    TEXT NOT NULL,
+    port       INTEGER NOT NULL,
+    pid        INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (channel, port)
+);
+"""
+_schema_ready: set[str] = set()
+
+
+def _conn():
+    conn = task_queue.connect()
+    if task_queue.QUEUE_DB not in _schema_ready:
+        conn.executescript(_SCHEMA)
+        _schema_ready.add(task_queue.QUEUE_DB)
+    return conn
+
+
+def ring(channel: str) -> int:
+    """唤醒该频道所有等待方，返回发送的数据报数"""
+    try:
+        conn = _conn()
+        conn.execute("DELETE FROM listeners WHERE updated_at < ?", (time.time() - STALE_SEC,))
+        ports = [r[0] for r in conn.execute("SELECT port FROM listeners WHERE channel = ?", (channel,))]
+    except Exception as e:
+        logger.warning(f"读取唤醒登记失败: {e}")
+        return 0
+    if not ports:
+        return 0
+    sent = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for port in ports:
+            try:
+                s.sendto(channel.encode(), ("127.0.0.1", port))
+                sent += 1
+            except OSError:
+                pass
+    return sent
+
+
+class Doorbell:
+    """一个或多个频道的唤醒接收端。用完调用 close()，或用 with 语句"""
+
+    def __init__(self, *channels: str):
+        self.channels = channels
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self._registered_at = 0.0
+        self._register()
+
+    def _register(self) -> None:
+        try:
+            _conn().executemany(
+                "INSERT OR REPLACE INTO listeners (channel, port, pid, updated_at) VALUES (?, ?, ?, ?)",
+                [(c, self.port, os.getpid(), time.time()) for c in self.channels],
+            )
+            self._registered_at = time.time()
+        except Exception as e:
+            logger.warning(f"登记唤醒端口失败: {e}")
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def poke(self) -> None:
+        """唤醒本接收端自己（可在其他线程调用）"""
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.sendto(b"poke", ("127.0.0.1", self.port))
+        except OSError:
+            pass
+
+    def drain(self) -> bool:
+        """读空缓冲区，返回是否收到过唤醒"""
+        got = False
+        while True:
+            try:
+                self.sock.recv(64)
+                got = True
+            except (BlockingIOError, InterruptedError):
+                return got
+            except OSError:
+                return got
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """等待唤醒，返回 True=被唤醒，False=超时"""
+        deadline = (time.time() + timeout) if timeout is not None else None
+        while True:
+            if time.time() - self._registered_at >= REFRESH_SEC:
+                self._register()
+            chunk = REFRESH_SEC
+            if deadline is not None:
+                chunk = min(chunk, max(deadline - time.time(), 0))
+            readable, _, _ = select.select([self.sock], [], [], chunk)
+            if readable and self.drain():
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+    def close(self) -> None:
+        try:
+            _conn().execute("DELETE FROM listeners WHERE port = ?", (self.port,))
+        except Exception:
+            pass
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+    def __enter__(self) -> "Doorbell":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class AsyncDoorbell(asyncio.DatagramProtocol):
+    """Doorbell 的 asyncio 版本：数据报由事件循环接收，等待不占线程。用 await AsyncDoorbell.open(...) 创建"""
+
+    def __init__(self, *channels: str):
+        self.channels = channels
+        self.port = 0
+        self._event = asyncio.Event()
+        self._transport: asyncio.DatagramTransport | None = None
+        self._registered_at = 0.0
+
+    @classmethod
+    async def open(cls, *channels: str) -> "AsyncDoorbell":
+        loop = asyncio.get_running_loop()
+        _, bell = await loop.create_datagram_endpoint(lambda: cls(*channels), local_addr=("127.0.0.1", 0))
+        await bell._register()
+        return bell
+
+    def connection_made(self, transport) -> None:
+        self._transport = transport
+        self.port = transport.get_extra_info("sockname")[1]
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self._event.set()
+
+    def poke(self) -> None:
+        """唤醒本接收端自己（须在事件循环线程调用）"""
+        self._event.set()
+
+    async def _register(self) -> None:
+        self._registered_at = time.time()
+        rows = [(c, self.port, os.getpid(), time.time()) for c in self.channels]
+        try:
+            await asyncio.to_thread(
+                lambda: _conn().executemany(
+                    "INSERT OR REPLACE INTO listeners (channel, port, pid, updated_at) VALUES (?, ?, ?, ?)", rows
+                )
+            )
+        except Exception as e:
+            logger.warning(f"登记唤醒端口失败: {e}")
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        """等待唤醒，返回 True=被唤醒，False=超时"""
+        deadline = (time.time() + timeout) if timeout is not None else None
+        while not self._event.is_set():
+            if time.time() - self._registered_at >= REFRESH_SEC:
+                await self._register()
+            chunk = REFRESH_SEC
+            if deadline is not None:
+                chunk = min(chunk, max(deadline - time.time(), 0))
+            try:
+                await asyncio.wait_for(self._event.wait(), chunk)
+            except asyncio.TimeoutError:
+                if deadline is not None and time.time() >= deadline:
+                    return False
+        self._event.clear()
+        return True
+
+    async def close(self) -> None:
+        port = self.port
+        if self._transport is not None:
+            self._transport.close()
+        try:
+            await asyncio.to_thread(lambda: _conn().execute("DELETE FROM listeners WHERE port = ?", (port,)))
+        except Exception:
+            pass
@@ -0,0 +1,285 @@
+"""
+grep_search 的三元组（trigram）索引：SQLite 持久化，按 mtime/size 增量更新
+
+- 索引 APPROVED_DIRECTORY 下的文本文件：每个文件记录其内容（小写）中出现过的所有 3 字节组合
+- 查询时从正则里提取必然出现的字面量，取其三元组求交集，只对候选文件跑正则
+- 提取不到足够长的字面量（如 `a.b`、`\\w+`）时返回 None，调用方退回全量扫描
+- 遍历规则同 grep_engine（跳过 .git、node_modules、.gitignore 忽略的文件），跳过二进制文件；过大的文件不建索引，但始终作为候选
+- 每 SEARCH_INDEX_REFRESH 秒最多全量更新一次；工具写过文件后只更新本次搜索的子目录
+
+索引只用来缩小范围，最终结果仍由正则在文件内容上确认，不会多报。
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+try:
+    import re._parser as _sre_parse  # Python 3.11+
+    from re import _constants as _sre
+except ImportError:  # pragma: no cover
+    import sre_parse as _sre_parse
+    import sre_constants as _sre
+from dotenv import load_dotenv
+
+import grep_engine
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_ENABLED = os.getenv("SEARCH_INDEX", "0") == "1"
+INDEX_DB = os.getenv("SEARCH_INDEX_DB") or os.path.join(BASE_DIR, ".tg_search_index.db")
+# 超过这么大的文件不建索引（查询时始终作为候选）
+MAX_FILE_BYTES = int(os.getenv("SEARCH_INDEX_MAX_FILE", str(1024 * 1024)))
+# 两次全量增量更新（遍历整个根目录 + stat）的最小间隔；
+# 工具写过文件后只立即更新本次搜索的子目录
+REFRESH_SEC = float(os.getenv("SEARCH_INDEX_REFRESH", "10"))
+# 每个候选集合最多用多少个三元组求交（足够筛选，查询更快）
+MAX_QUERY_TRIGRAMS = 24
+MAX_ALTERNATIVES = 16
+
+# files.status
+INDEXED, UNINDEXED, BINARY = 1, 0, 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id       INTEGER PRIMARY KEY,
+    root     TEXT NOT NULL,
+    path     TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size     INTEGER NOT NULL,
+    status   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_root ON files (root);
+CREATE TABLE IF NOT EXISTS trigrams (
+    tri     INTEGER NOT NULL,
+    file_id INTEGER NOT NULL,
+    PRIMARY KEY (tri, file_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trigrams_file ON trigrams (file_id);
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized: set[str] = set()
+_refresh_lock = threading.Lock()
+# root -> (上次全量更新时间, 上次全量更新时的写入代数)
+_refreshed: dict[str, tuple[float, int | None]] = {}
+# (root, 子目录) -> 上次更新该子目录时的写入代数；全量更新后清空
+_refreshed_subtrees: dict[tuple[str, str], int | None] = {}
+
+
+def connect() -> sqlite3.Connection:
+    """当前线程的索引库连接"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", None) == INDEX_DB:
+        return conn
+    conn = sqlite3.connect(INDEX_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with _init_lock:
+        if INDEX_DB not in _initialized:
+            conn.executescript(_SCHEMA)
+            _initialized.add(INDEX_DB)
+    _local.conn = conn
+    _local.path = INDEX_DB
+    return conn
+
+
+def trigrams(data: bytes) -> set[int]:
+    """3 字节组合，编码为 24 位整数"""
+    return {int.from_bytes(data[i:i + 3], "big") for i in range(len(data) - 2)}
+
+
+def _normalize(text: str) -> bytes:
+    return text.lower().encode("utf-8")
+
+
+def is_binary(chunk: bytes) -> bool:
+    return b"\0" in chunk[:grep_engine.BINARY_SNIFF]
+
+
+# ============ 建索引 ============
+def _walk(root: str, top: str):
+    """与 grep_engine 从 root 遍历相同的规则（SKIP_DIRS、.gitignore），只走 top 以下，产出 (path, stat)"""
+    for entry in grep_engine.iter_files(top, base=root):
+        try:
+            yield entry.path, entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+
+
+def _index_file(conn: sqlite3.Connection, root: str, path: str, st: os.stat_result, file_id: int | None) -> None:
+    status, tris = UNINDEXED, set()
+    if st.st_size <= MAX_FILE_BYTES:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if is_binary(data):
+                status = BINARY
+            else:
+                status = INDEXED
+                tris = trigrams(_normalize(data.decode("utf-8", errors="replace")))
+        except OSError:
+            status = UNINDEXED
+    if file_id is not None:
+        conn.execute("DELETE FROM trigrams WHERE file_id = ?", (file_id,))
+        conn.execute(
+            "UPDATE files SET mtime_ns = ?, size = ?, status = ? WHERE id = ?",
+            (st.st_mtime_ns, st.st_size, status, file_id),
+        )
+    else:
+        file_id = conn.execute(
+            "INSERT INTO files (root, path, mtime_ns, size, status) VALUES (?, ?, ?, ?, ?)",
+            (root, path, st.st_mtime_ns, st.st_size, status),
+        ).lastrowid
+    if tris:
+        conn.executemany("INSERT INTO trigrams (tri, file_id) VALUES (?, ?)", ((t, file_id) for t in tris))
+
+
+def refresh(root: str, subtree: str | None = None) -> tuple[int, int]:
+    """
+    按 mtime/size 增量更新 root 下的索引，返回 (更新文件数, 删除文件数)
+    subtree 为 root 下的目录时只遍历、只删除这个目录以下的记录
+    """
+    root = os.path.abspath(root)
+    top = os.path.abspath(subtree) if subtree else root
+    conn = connect()
+    sql, params = "SELECT id, path, mtime_ns, size FROM files WHERE root = ?", (root,)
+    if top != root:
+        prefix = top.rstrip(os.sep) + os.sep
+        sql, params = sql + " AND substr(path, 1, ?) = ?", (root, len(prefix), prefix)
+    known = {path: (fid, mtime_ns, size) for fid, path, mtime_ns, size in conn.execute(sql, params)}
+    seen: set[str] = set()
+    updated = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for path, st in _walk(root, top):
+            seen.add(path)
+            old = known.get(path)
+            if old is not None and old[1] == st.st_mtime_ns and old[2] == st.st_size:
+                continue
+            _index_file(conn, root, path, st, old[0] if old else None)
+            updated += 1
+            if updated % 500 == 0:
+                conn.execute("COMMIT")
+                conn.execute("BEGIN IMMEDIATE")
+        gone = [known[p][0] for p in known.keys() - seen]
+        for fid in gone:
+            conn.execute("DELETE FROM trigrams WHERE file_id = ?", (fid,))
+            conn.execute("DELETE FROM files WHERE id = ?", (fid,))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if updated or gone:
+        logger.info(f"搜索索引更新 {top}: {updated} 个文件重建，{len(gone)} 个删除")
+    return updated, len(gone)
+
+
+def _ensure_fresh(root: str, generation: int | None, subtree: str | None = None) -> None:
+    """
+    距上次全量更新超过 REFRESH_SEC 时更新整个 root；
+    否则写入代数变了只更新要搜索的 subtree，不为一次写入遍历整个根目录
+    """
+    with _refresh_lock:
+        now = time.monotonic()
+        last, last_gen = _refreshed.get(root, (0.0, None))
+        top = os.path.abspath(subtree) if subtree else root
+        if now - last >= REFRESH_SEC or (top == root and generation not in (None, last_gen)):
+            refresh(root)
+            _refreshed[root] = (now, generation)
+            for key in [k for k in _refreshed_subtrees if k[0] == root]:
+                del _refreshed_subtrees[key]
+            return
+        if generation is None or generation == last_gen or _refreshed_subtrees.get((root, top)) == generation:
+            return
+        refresh(root, top)
+        _refreshed_subtrees[(root, top)] = generation
+
+
+# ============ 查询 ============
+def _required(items, depth: int = 0) -> list[list[str]]:
+    """
+    正则里必然出现的字面量，形如 [[alt1 的字面量...], [alt2 的字面量...]]（各分支取或）
+    只识别顺序、分组、至少出现一次的重复和分支；其余节点视为通配，截断字面量
+    """
+    runs: list[str] = []
+    alts: list[list[str]] | None = None
+    cur: list[str] = []
+
+    def flush() -> None:
+        if cur:
+            runs.append("".join(cur))
+            cur.clear()
+
+    for op, av in items:
+        if op is _sre.LITERAL:
+            cur.append(chr(av))
+            continue
+        flush()
+        sub: list[list[str]] | None = None
+        if op is _sre.SUBPATTERN:
+            sub = _required(av[-1], depth + 1)
+        elif op in (_sre.MAX_REPEAT, _sre.MIN_REPEAT) and av[0] >= 1:
+            sub = _required(av[2], depth + 1)
+        elif op is _sre.BRANCH:
+            sub = [alt for branch in av[1] for alt in _required(branch, depth + 1)]
+        if not sub:
+            continue
+        if len(sub) == 1:
+            runs.extend(sub[0])
+        elif alts is None and len(sub) <= MAX_ALTERNATIVES:
+            alts = sub
+    flush()
+    if alts is None:
+        return [runs]
+    return [runs + alt for alt in alts]
+
+
+def query_trigrams(pattern: str) -> list[set[int]] | None:
+    """每个分支需要的三元组集合；任一分支没有可用三元组时返回 None（无法缩小范围）"""
+    try:
+        parsed = _sre_parse.parse(pattern)
+    except Exception:
+        return None
+    result = []
+    for literals in _required(list(parsed)):
+        tris: set[int] = set()
+        for lit in literals:
+            tris |= trigrams(_normalize(lit))
+        if not tris:
+            return None
+        result.append(tris)
+    return result or None
+
+
+def candidates(
+    root: str, pattern: str, generation: int | None = None, subtree: str | None = None
+) -> list[str] | None:
+    """
+    root 下可能匹配 pattern 的文件（已排序）；无法用索引缩小范围时返回 None
+    generation 为调用方的写入代数，变化时先增量更新索引（给出 subtree 时只更新要搜索的子目录）
+    """
+    plan = query_trigrams(pattern)
+    if plan is None:
+        return None
+    root = os.path.abspath(root)
+    _ensure_fresh(root, generation, subtree)
+    conn = connect()
+    paths: set[str] = set()
+    for tris in plan:
+        picked = sorted(tris)[:MAX_QUERY_TRIGRAMS]
+        marks = ",".join("?" * len(picked))
+        rows = conn.execute(
+            f"SELECT f.path FROM trigrams t JOIN files f ON f.id = t.file_id "
+            f"WHERE t.tri IN ({marks}) AND f.root = ? GROUP BY t.file_id HAVING COUNT(*) = ?",
+            (*picked, root, len(picked)),
+        )
+        paths.update(r[0] for r in rows)
+    paths.update(
+        r[0] for r in conn.execute("SELECT path FROM files WHERE root = ? AND status = ?", (root, UNINDEXED))
+    )
+    return sorted(paths)
@@ -0,0 +1,326 @@
+"""
+出站发送队列：按 Telegram 限流规则调度所有消息
+
+- 不同 chat 在线程池里并发发送，慢的 chat 不拖累其他 chat；同一 chat 保持顺序
+- 每个 chat 一个令牌桶（默认 1 条/秒），全局一个令牌桶（默认 30 条/秒）
+- 429 时按 retry_after 暂停该 chat 并重试，不再丢消息；网络错误有限次退避重试
+- 同一 coalesce_key 仍在排队的消息会合并成一条（用于同一任务的进度汇报）
+- 编辑消息（submit_edit）同 key 只保留最新内容，可指定延迟发送用于节流
+
+submit 返回 Future，结果为 Bot API 的 result（如 Message），失败时抛异常。
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import telegram_client
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "1"))
+# 并发发送线程数：不同 chat 同时发，同一 chat 仍按顺序一次一条
+SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", "8"))
+MAX_RETRIES = 3
+MAX_TEXT = 4000
+# 进程退出前最多等待多久把队列发完
+FLUSH_ON_EXIT_SEC = 5
+
+
+class TokenBucket:
+    """令牌桶：rate 个/秒，最多攒 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, now: float) -> float:
+        """还要等多久才有一个令牌（0 表示现在就有）"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Outgoing:
+    """一条待发消息；合并时 bodies 追加，所有 futures 共享发送结果"""
+
+    def __init__(
+        self,
+        chat_id: str,
+        method: str,
+        payload: dict[str, Any],
+        header: str,
+        body: str,
+        coalesce_key: str | None,
+        token: str | None,
+    ):
+        self.chat_id = chat_id
+        self.method = method
+        self.payload = payload
+        self.header = header
+        self.bodies = [body]
+        self.coalesce_key = coalesce_key
+        self.token = token
+        self.futures: list[Future] = []
+        self.attempts = 0
+        self.in_flight = False
+        self.not_before = 0.0
+
+    def text(self) -> str:
+        bodies = list(self.bodies)
+        while True:
+            text = (f"{self.header}\n\n" if self.header else "") + "\n\n".join(bodies)
+            if len(text) <= MAX_TEXT or len(bodies) == 1:
+                return text[:MAX_TEXT]
+            bodies.pop(0)  # 太长时丢弃最早的合并内容，保留最新进度
+
+    def build_payload(self) -> dict[str, Any]:
+        payload = dict(self.payload)
+        payload["chat_id"] = self.chat_id
+        payload["text"] = self.text()
+        return payload
+
+    def resolve(self, result: Any = None, error: BaseException | None = None) -> None:
+        for fut in self.futures:
+            if fut.done():
+                continue
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(result)
+
+
+class SendScheduler:
+    """一个调度线程按令牌桶节奏分派，发送在线程池里并发进行"""
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: float = CHAT_BURST,
+        workers: int = SEND_WORKERS,
+    ):
+        self._cond = threading.Condition()
+        self._queues: dict[str, deque[_Outgoing]] = {}
+        self._chat_buckets: dict[str, TokenBucket] = {}
+        self._blocked_until: dict[str, float] = {}
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._order: deque[str] = deque()
+        self._thread: threading.Thread | None = None
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="tg-send")
+
+    def submit(
+        self,
+        chat_id: str | int,
+        text: str,
+        parse_mode: str | None = "Markdown",
+        reply_markup: dict | None = None,
+        header: str = "",
+        coalesce_key: str | None = None,
+        token: str | None = None,
+    ) -> Future:
+        """排队发送 header + text；coalesce_key 相同且仍在排队时合并为一条"""
+        payload = self._base_payload(parse_mode, reply_markup)
+        return self._enqueue(str(chat_id), "sendMessage", payload, header, text, coalesce_key, False, token, 0.0)
+
+    def submit_edit(
+        self,
+        chat_id: str | int,
+        message_id: int,
+        text: str,
+        parse_mode: str | None = "Markdown",
+        coalesce_key: str | None = None,
+        delay: float = 0.0,
+        token: str | None = None,
+    ) -> Future:
+        """排队编辑消息；coalesce_key 相同且仍在排队时只保留最新内容。delay 秒内不发送"""
+        payload = self._base_payload(parse_mode, None)
+        payload["message_id"] = message_id
+        not_before = time.monotonic() + delay if delay > 0 else 0.0
+        return self._enqueue(str(chat_id), "editMessageText", payload, "", text, coalesce_key, True, token, not_before)
+
+    @staticmethod
+    def _base_payload(parse_mode: str | None, reply_markup: dict | None) -> dict[str, Any]:
+        payload: dict[str, Any] = {}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        return payload
+
+    def _enqueue(
+        self,
+        chat_id: str,
+        method: str,
+        payload: dict[str, Any],
+        header: str,
+        text: str,
+        coalesce_key: str | None,
+        replace: bool,
+        token: str | None,
+        not_before: float,
+    ) -> Future:
+        fut: Future = Future()
+        with self._cond:
+            q = self._queues.setdefault(chat_id, deque())
+            item = None
+            if coalesce_key:
+                item = next((x for x in q if x.coalesce_key == coalesce_key and not x.in_flight), None)
+            if item is not None and replace:
+                item.bodies = [text]
+                item.payload = payload
+            elif item is not None:
+                item.bodies.append(text)
+            else:
+                item = _Outgoing(chat_id, method, payload, header, text, coalesce_key, token)
+                item.not_before = not_before
+                q.append(item)
+                if chat_id not in self._order:
+                    self._order.append(chat_id)
+            item.futures.append(fut)
+            self._ensure_thread()
+            self._cond.notify()
+        return fut
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """等待队列发完，返回是否在超时前发完"""
+        deadline = (time.monotonic() + timeout) if timeout is not None else None
+        with self._cond:
+            while any(self._queues.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="tg-send-queue", daemon=True)
+            self._thread.start()
+
+    def _bucket(self, chat_id: str) -> TokenBucket:
+        b = self._chat_buckets.get(chat_id)
+        if b is None:
+            b = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return b
+
+    def _next_ready(self) -> tuple[_Outgoing | None, float]:
+        """轮询各 chat，返回可以立即发送的消息，或需要等待的秒数"""
+        now = time.monotonic()
+        wait = 3600.0
+        for _ in range(len(self._order)):
+            chat_id = self._order[0]
+            self._order.rotate(-1)
+            q = self._queues.get(chat_id)
+            if not q or q[0].in_flight:
+                continue
+            d = max(
+                self._blocked_until.get(chat_id, 0) - now,
+                q[0].not_before - now,
+                self._bucket(chat_id).delay(now),
+            )
+            if d > 0:
+                wait = min(wait, d)
+                continue
+            g = self._global.delay(now)
+            if g > 0:
+                return None, g
+            self._bucket(chat_id).take(now)
+            self._global.take(now)
+            return q[0], 0.0
+        return None, wait
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._order = deque(c for c in self._order if self._queues.get(c))
+                for c in self._queues:
+                    if self._queues[c] and c not in self._order:
+                        self._order.append(c)
+                item, wait = self._next_ready()
+                if item is None:
+                    self._cond.wait(wait if self._order else None)
+                    continue
+                item.attempts += 1
+                item.in_flight = True
+                payload = item.build_payload()
+            try:
+                self._pool.submit(self._deliver, item, payload)
+            except RuntimeError:
+                # 解释器退出时线程池已关闭，改为就地发送（flush 仍可把队列发完）
+                self._deliver(item, payload)
+
+    def _deliver(self, item: _Outgoing, payload: dict[str, Any]) -> None:
+        result, error, retry_in = None, None, None
+        try:
+            result = telegram_client.call(item.method, payload, token=item.token)
+        except telegram_client.TelegramAPIError as e:
+            if "message is not modified" in e.description:
+                result = True
+            elif e.retry_after is not None and item.attempts <= MAX_RETRIES:
+                retry_in = float(e.retry_after)
+                logger.warning(f"Telegram 限流 chat={item.chat_id}，{retry_in}s 后重试")
+            else:
+                error = e
+        except Exception as e:
+            if item.attempts <= MAX_RETRIES:
+                retry_in = 2 ** item.attempts
+                logger.warning(f"发送失败 chat={item.chat_id}（第 {item.attempts} 次）: {e}")
+            else:
+                error = e
+        with self._cond:
+            item.in_flight = False
+            q = self._queues.get(item.chat_id)
+            if retry_in is not None:
+                self._blocked_until[item.chat_id] = time.monotonic() + retry_in
+            elif q and q[0] is item:
+                q.popleft()
+            self._cond.notify_all()
+        if retry_in is None:
+            # 在锁外回调，避免回调里再次 submit 时与调用方的锁交叉
+            if error is not None:
+                logger.error(f"发送失败 chat={item.chat_id}: {error}")
+            item.resolve(result, error)
+
+
+_scheduler = SendScheduler()
+
+
+def submit(chat_id: str | int, text: str, **kwargs: Any) -> Future:
+    """排队发送，见 SendScheduler.submit"""
+    return _scheduler.submit(chat_id, text, **kwargs)
+
+
+def submit_edit(chat_id: str | int, message_id: int, text: str, **kwargs: Any) -> Future:
+    """排队编辑消息，见 SendScheduler.submit_edit"""
+    return _scheduler.submit_edit(chat_id, message_id, text, **kwargs)
+
+
+def flush(timeout: float | None = None) -> bool:
+    return _scheduler.flush(timeout)
+
+
+atexit.register(lambda: _scheduler.flush(FLUSH_ON_EXIT_SEC))
@@ -0,0 +1,155 @@
+"""
+任务状态卡片：每个任务只发一条消息，之后的进度用 editMessageText 原地更新
+
+- 第一次 report 发送卡片，记下每个 chat 的 message_id
+- 之后的 report / report_done 编辑同一条消息
+- 内容没变就不发；编辑之间至少间隔 MIN_EDIT_INTERVAL 秒，期间的更新只保留最新一版
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+
+import send_queue
+
+logger = logging.getLogger(__name__)
+
+MIN_EDIT_INTERVAL = float(os.getenv("STATUS_CARD_MIN_INTERVAL", "3"))
+# 卡片里保留的最近步骤数
+MAX_STEPS = 8
+
+
+class StatusCard:
+    """一个任务在各个 chat 中的状态卡片"""
+
+    def __init__(self, task_id: str, chat_ids: list[str], token: str | None):
+        self.task_id = task_id
+        self.chat_ids = chat_ids
+        self.token = token
+        self.steps: list[tuple[str, str]] = []
+        self.final: str | None = None
+        self._lock = threading.RLock()
+        self._message_ids: dict[str, int] = {}
+        self._creating: dict[str, Future] = {}
+        # 卡片还在发送中时 finish 返回的 Future：等补发的最终编辑完成才有结果
+        self._final_futures: dict[str, Future] = {}
+        self._last_text: dict[str, str] = {}
+        self._last_edit: dict[str, float] = {}
+
+    def render(self) -> str:
+        tid = f" `{self.task_id}`" if self.task_id else ""
+        if self.final is not None:
+            head = f"✅ **【任务完成】**{tid}"
+        else:
+            head = f"📋 **【进度汇报】**{tid}"
+        lines = [head, ""]
+        shown = self.steps[-MAX_STEPS:]
+        if len(self.steps) > len(shown):
+            lines.append(f"…（前 {len(self.steps) - len(shown)} 步已折叠）")
+        for i, (step, message) in enumerate(shown):
+            if i == len(shown) - 1 and self.final is None:
+                lines.append(f"▶️ **{step}**\n{message}")
+            else:
+                lines.append(f"✔️ {step}")
+        if self.final is not None:
+            lines += ["", self.final]
+        return "\n".join(lines)
+
+    def update(self, step: str, message: str) -> dict[str, Future]:
+        with self._lock:
+            self.steps.append((step, message))
+            return self._push()
+
+    def finish(self, message: str) -> dict[str, Future]:
+        with self._lock:
+            self.final = message
+            return self._push(final=True)
+
+    def _push(self, final: bool = False) -> dict[str, Future]:
+        """把当前内容推到每个 chat：未创建则发送，已创建则（节流后）编辑。返回 {chat_id: Future}"""
+        text = self.render()
+        futures: dict[str, Future] = {}
+        for chat_id in self.chat_ids:
+            if chat_id in self._message_ids:
+                if self._last_text.get(chat_id) == text:
+                    continue
+                now = time.monotonic()
+                slot = self._last_edit.get(chat_id, 0)
+                if slot > now:
+                    # 已有一次排队中的编辑，合并进去（send_queue 只保留最新内容）
+                    delay = slot - now
+                else:
+                    delay = 0.0 if final else max(slot + MIN_EDIT_INTERVAL - now, 0)
+                    self._last_edit[chat_id] = now + delay
+                self._last_text[chat_id] = text
+                futures[chat_id] = send_queue.submit_edit(
+                    chat_id, self._message_ids[chat_id], text,
+                    coalesce_key=f"card:{self.task_id}", delay=delay, token=self.token,
+                )
+            elif chat_id in self._creating:
+                # 卡片还在发送中，发出后再补一次编辑
+                if final:
+                    futures[chat_id] = self._final_futures.setdefault(chat_id, Future())
+                else:
+                    futures[chat_id] = self._creating[chat_id]
+            else:
+                self._last_text[chat_id] = text
+                self._last_edit[chat_id] = time.monotonic()
+                fut = send_queue.submit(chat_id, text, token=self.token)
+                self._creating[chat_id] = fut
+                fut.add_done_callback(lambda f, c=chat_id: self._created(c, f))
+                futures[chat_id] = fut
+        return futures
+
+    def _created(self, chat_id: str, fut: Future) -> None:
+        with self._lock:
+            self._creating.pop(chat_id, None)
+            waiter = self._final_futures.pop(chat_id, None)
+            if fut.cancelled() or fut.exception() is not None:
+                self._last_text.pop(chat_id, None)
+                if waiter is not None:
+                    waiter.set_exception(fut.exception() if not fut.cancelled() else RuntimeError("卡片发送已取消"))
+                return
+            result = fut.result()
+            edit = None
+            if isinstance(result, dict) and "message_id" in result:
+                self._message_ids[chat_id] = result["message_id"]
+                if self._last_text.get(chat_id) != self.render():
+                    edit = self._push(final=self.final is not None).get(chat_id)
+            if waiter is not None:
+                if edit is None:
+                    waiter.set_result(result)
+                else:
+                    edit.add_done_callback(lambda f: _chain(f, waiter))
+
+
+def _chain(source: Future, target: Future) -> None:
+    if source.cancelled():
+        target.set_exception(RuntimeError("编辑已取消"))
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+_cards: dict[str, StatusCard] = {}
+_cards_lock = threading.Lock()
+
+
+def update(task_id: str, step: str, message: str, chat_ids: list[str], token: str | None = None) -> dict[str, Future]:
+    """记录一步进度并刷新卡片"""
+    with _cards_lock:
+        card = _cards.get(task_id)
+        if card is None:
+            card = _cards[task_id] = StatusCard(task_id, chat_ids, token)
+    return card.update(step, message)
+
+
+def finish(task_id: str, message: str) -> dict[str, Future] | None:
+    """把卡片改为完成状态并移除；该任务没有卡片时返回 None"""
+    with _cards_lock:
+        card = _cards.pop(task_id, None)
+    if card is None:
+        return None
+    return card.finish(message)
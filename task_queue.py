@@ -0,0 +1,342 @@
+"""
+任务队列：SQLite（WAL 模式）替代 .tg_task_*.txt 文件扫描
+
+- enqueue: 入队，按入队顺序（自增 seq）排队，真正 FIFO
+- claim: 原子地取出并删除队首任务（BEGIN IMMEDIATE 事务）；unclaim 放回队首
+- pending_count: 触发器维护的计数器，O(1)
+- claim_for / complete / release: daemon 多槽位执行，任务在 running 表里直到按 task_id 完成
+- 运行中的任务持有租约（owner、开始时间、到期时间），renew 续约；
+  reap_expired 回收过期租约、abandon 主动放弃：重新入队，超过重试次数则判定失败
+- 每次领取分配一个租约令牌（owner#attempts），带令牌的 renew/complete 只作用于这一次领取
+- 首次打开时自动迁移旧版 .tg_task_*.txt 文件
+
+Bot、MCP 服务器、daemon 是不同进程，共享同一个数据库文件。
+"""
+import os
+import glob
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+QUEUE_DB = os.getenv("TASK_QUEUE_DB") or os.path.join(BASE_DIR, ".tg_queue.db")
+LEGACY_TASK_DIR = BASE_DIR
+LEGACY_TASK_PREFIX = ".tg_task_"
+# 租约时长：report_progress 每次续约，超过这么久没有心跳视为 Agent 卡死
+LEASE_TTL = float(os.getenv("TASK_LEASE_TTL", "900"))
+# 同一任务最多被领取几次，超过后判定失败不再重试
+MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "2"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id    TEXT NOT NULL UNIQUE,
+    content    TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts   INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name  TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats (name, value) VALUES ('pending', 0);
+CREATE TRIGGER IF NOT EXISTS tasks_ins AFTER INSERT ON tasks BEGIN
+    UPDATE stats SET value = value + 1 WHERE name = 'pending';
+END;
+CREATE TRIGGER IF NOT EXISTS tasks_del AFTER DELETE ON tasks BEGIN
+    UPDATE stats SET value = value - 1 WHERE name = 'pending';
+END;
+CREATE TABLE IF NOT EXISTS running (
+    task_id    TEXT PRIMARY KEY,
+    seq        INTEGER NOT NULL,
+    content    TEXT NOT NULL,
+    slot       INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    owner      TEXT NOT NULL DEFAULT '',
+    expires_at REAL NOT NULL DEFAULT 0,
+    attempts   INTEGER NOT NULL DEFAULT 0
+);
+"""
+# 旧库缺少的列：(表, 列, 定义)
+_COLUMNS = [
+    ("tasks", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("running", "owner", "TEXT NOT NULL DEFAULT ''"),
+    ("running", "expires_at", "REAL NOT NULL DEFAULT 0"),
+    ("running", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized: set[str] = set()
+
+
+def connect() -> sqlite3.Connection:
+    """当前线程的数据库连接（每线程一个，自动建表并迁移旧文件）"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", None) == QUEUE_DB:
+        return conn
+    conn = sqlite3.connect(QUEUE_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    with _init_lock:
+        if QUEUE_DB not in _initialized:
+            conn.executescript(_SCHEMA)
+            _ensure_columns(conn)
+            _initialized.add(QUEUE_DB)
+            _migrate_legacy_files(conn)
+    _local.conn = conn
+    _local.path = QUEUE_DB
+    return conn
+
+
+class _Tx:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK，跨进程写互斥"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def transaction() -> _Tx:
+    """写事务：with transaction() as conn: ..."""
+    return _Tx(connect())
+
+
+def _new_task_id() -> str:
+    return str(uuid.uuid4())[:8]
+
+
+def enqueue(content: str, task_id: str = "") -> str:
+    """入队，返回 task_id"""
+    task_id = task_id or _new_task_id()
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO tasks (task_id, content, created_at) VALUES (?, ?, ?)",
+            (task_id, content, time.time()),
+        )
+    return task_id
+
+
+def claim() -> tuple[str, str] | None:
+    """原子地取出并删除最早入队的任务，返回 (task_id, content) 或 None"""
+    with transaction() as conn:
+        row = conn.execute("SELECT seq, task_id, content FROM tasks ORDER BY seq LIMIT 1").fetchone()
+        if row is None:
+            return None
+        conn.execute("DELETE FROM tasks WHERE seq = ?", (row[0],))
+    return row[1], row[2]
+
+
+def unclaim(task_id: str, content: str) -> None:
+    """把 claim() 取出、但没能交给任何等待方的任务放回队首"""
+    with transaction() as conn:
+        # running 里的 seq 会在 release/回收时原样放回 tasks，新 seq 也要避开它们
+        conn.execute(
+            "INSERT INTO tasks (seq, task_id, content, created_at)"
+            " VALUES ((SELECT COALESCE(MIN(seq), 1) - 1 FROM"
+            " (SELECT seq FROM tasks UNION ALL SELECT seq FROM running)), ?, ?, ?)",
+            (task_id, content, time.time()),
+        )
+
+
+def lease_token(owner: str, attempts: int) -> str:
+    """一次领取的租约令牌：同一任务被回收后再次领取，attempts 不同，令牌也不同"""
+    return f"{owner}#{attempts}"
+
+
+def claim_for(slot: int, owner: str = "", ttl: float = LEASE_TTL) -> tuple[str, str, str] | None:
+    """
+    原子地把队首任务移入 running 表并分配给 slot，同时取得租约
+    返回 (task_id, content, token) 或 None
+    """
+    now = time.time()
+    with transaction() as conn:
+        row = conn.execute("SELECT seq, task_id, content, attempts FROM tasks ORDER BY seq LIMIT 1").fetchone()
+        if row is None:
+            return None
+        conn.execute("DELETE FROM tasks WHERE seq = ?", (row[0],))
+        conn.execute(
+            "INSERT INTO running (task_id, seq, content, slot, started_at, owner, expires_at, attempts)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (row[1], row[0], row[2], slot, now, owner, now + ttl, row[3] + 1),
+        )
+    return row[1], row[2], lease_token(owner, row[3] + 1)
+
+
+def _resolve_running(conn: sqlite3.Connection, task_id: str) -> str | None:
+    """task_id 为空时，仅当恰好只有一个运行中任务才返回它（兼容不带 task_id 的调用）"""
+    if task_id:
+        return task_id
+    rows = conn.execute("SELECT task_id FROM running LIMIT 2").fetchall()
+    return rows[0][0] if len(rows) == 1 else None
+
+
+def _match(task_id: str, token: str) -> tuple[str, tuple]:
+    """按 task_id（及令牌）定位 running 行的 WHERE 子句和参数；不带令牌时只按 task_id 匹配"""
+    if token:
+        return "task_id = ? AND owner || '#' || attempts = ?", (task_id, token)
+    return "task_id = ?", (task_id,)
+
+
+def renew(task_id: str = "", ttl: float = LEASE_TTL, token: str = "") -> bool:
+    """
+    心跳：把租约延长到 now + ttl，返回租约是否仍存在
+    token 非空时只续约这一次领取（任务已被回收、重新领取后旧执行方的心跳不生效）
+    """
+    with transaction() as conn:
+        task_id = _resolve_running(conn, task_id)
+        if not task_id:
+            return False
+        where, params = _match(task_id, token)
+        n = conn.execute(f"UPDATE running SET expires_at = ? WHERE {where}", (time.time() + ttl, *params)).rowcount
+    return bool(n)
+
+
+def complete(task_id: str = "", token: str = "") -> str | None:
+    """标记运行中的任务完成，返回完成的 task_id；token 非空时只完成这一次领取"""
+    with transaction() as conn:
+        task_id = _resolve_running(conn, task_id)
+        if not task_id:
+            return None
+        where, params = _match(task_id, token)
+        n = conn.execute(f"DELETE FROM running WHERE {where}", params).rowcount
+    return task_id if n else None
+
+
+def _requeue(conn: sqlite3.Connection, task_id: str) -> bool:
+    row = conn.execute("SELECT seq, content, attempts FROM running WHERE task_id = ?", (task_id,)).fetchone()
+    if row is None:
+        return False
+    conn.execute("DELETE FROM running WHERE task_id = ?", (task_id,))
+    conn.execute(
+        "INSERT INTO tasks (seq, task_id, content, created_at, attempts) VALUES (?, ?, ?, ?, ?)",
+        (row[0], task_id, row[1], time.time(), row[2]),
+    )
+    return True
+
+
+def release(task_id: str) -> bool:
+    """把运行中的任务放回队列原位置（保留原 seq，仍按入队顺序排在前面），不计入重试次数"""
+    with transaction() as conn:
+        conn.execute("UPDATE running SET attempts = MAX(attempts - 1, 0) WHERE task_id = ?", (task_id,))
+        return _requeue(conn, task_id)
+
+
+def _retire(conn: sqlite3.Connection, task_id: str, attempts: int, max_attempts: int) -> bool:
+    """未超重试次数的放回队列（返回 True），否则删除判定失败（返回 False）"""
+    if attempts < max_attempts:
+        return _requeue(conn, task_id)
+    conn.execute("DELETE FROM running WHERE task_id = ?", (task_id,))
+    return False
+
+
+def reap_expired(max_attempts: int = MAX_ATTEMPTS) -> list[tuple[str, str, bool]]:
+    """
+    回收租约已过期的任务：未超重试次数的放回队列，否则删除判定失败
+    返回 [(task_id, content, requeued)]
+    """
+    reaped = []
+    with transaction() as conn:
+        rows = conn.execute(
+            "SELECT task_id, content, attempts FROM running WHERE expires_at < ?", (time.time(),)
+        ).fetchall()
+        for task_id, content, attempts in rows:
+            reaped.append((task_id, content, _retire(conn, task_id, attempts, max_attempts)))
+    return reaped
+
+
+def abandon(task_id: str, max_attempts: int = MAX_ATTEMPTS, token: str = "") -> tuple[str, bool] | None:
+    """
+    执行方主动放弃运行中的任务（卡住后被取消）：与租约过期同样处理
+    返回 (content, requeued)；任务不在 running 表（或令牌不符）时返回 None
+    """
+    with transaction() as conn:
+        where, params = _match(task_id, token)
+        row = conn.execute(f"SELECT content, attempts FROM running WHERE {where}", params).fetchone()
+        if row is None:
+            return None
+        return row[0], _retire(conn, task_id, row[1], max_attempts)
+
+
+def running() -> dict[str, int]:
+    """运行中的任务 {task_id: slot}"""
+    return dict(connect().execute("SELECT task_id, slot FROM running").fetchall())
+
+
+def leases() -> list[dict]:
+    """所有运行中任务的租约信息"""
+    rows = connect().execute(
+        "SELECT task_id, slot, owner, started_at, expires_at, attempts FROM running ORDER BY started_at"
+    ).fetchall()
+    keys = ("task_id", "slot", "owner", "started_at", "expires_at", "attempts")
+    return [dict(zip(keys, r)) for r in rows]
+
+
+def has_pending() -> bool:
+    """有待处理任务吗？（不消费）"""
+    return pending_count() > 0
+
+
+def pending_count() -> int:
+    """待处理任务数，O(1)"""
+    row = connect().execute("SELECT value FROM stats WHERE name = 'pending'").fetchone()
+    return max(int(row[0]), 0) if row else 0
+
+
+def clear() -> int:
+    """清空队列，返回删除的任务数"""
+    with transaction() as conn:
+        n = conn.execute("DELETE FROM tasks").rowcount
+    return n
+
+
+def _ensure_columns(conn: sqlite3.Connection) -> None:
+    """给旧版数据库补上新增的列"""
+    for table, column, decl in _COLUMNS:
+        cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _migrate_legacy_files(conn: sqlite3.Connection) -> int:
+    """把旧版 .tg_task_<id>.txt 按修改时间导入队列，导入后删除文件"""
+    files = glob.glob(os.path.join(LEGACY_TASK_DIR, f"{LEGACY_TASK_PREFIX}*.txt"))
+    if not files:
+        return 0
+    files.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+    migrated = 0
+    for path in files:
+        task_id = os.path.basename(path)[len(LEGACY_TASK_PREFIX):-len(".txt")] or _new_task_id()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read().strip()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR IGNORE INTO tasks (task_id, content, created_at) VALUES (?, ?, ?)",
+                    (task_id, content, os.path.getmtime(path)),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            os.remove(path)
+            migrated += 1
+        except Exception as e:
+            logger.warning(f"迁移旧任务文件失败 {path}: {e}")
+    if migrated:
+        logger.info(f"已迁移 {migrated} 个旧任务文件到队列")
+    return migrated
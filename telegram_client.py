@@ -0,0 +1,173 @@
+"""
+Telegram Bot API 客户端：进程内共享连接池
+
+- 同步：一个 requests.Session（HTTP keep-alive + 连接池），线程安全地复用
+- 异步：每个事件循环一个 httpx.AsyncClient（python-telegram-bot 已依赖 httpx）
+- 超时、连接池大小、API 地址均可通过环境变量配置
+
+middleware、tg_send、tg_ask 共用，不再每条消息重新握手 TCP+TLS。
+"""
+import os
+import asyncio
+import logging
+import threading
+from typing import Any
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "10"))
+POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "10"))
+
+
+class TelegramAPIError(Exception):
+    """Bot API 返回 ok=false。retry_after 非空表示被限流（429）"""
+
+    def __init__(self, method: str, error_code: int, description: str, retry_after: float | None = None):
+        super().__init__(f"{method}: {error_code} {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+
+_session = None
+_session_lock = threading.Lock()
+_async_clients: dict[int, Any] = {}
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+
+def _url(method: str, token: str | None) -> str:
+    token = token or TOKEN
+    if not token:
+        raise ValueError("未配置 TELEGRAM_BOT_TOKEN")
+    return f"{API_BASE}/bot{token}/{method}"
+
+
+def _unwrap(method: str, status: int, data: Any) -> Any:
+    if isinstance(data, dict) and data.get("ok"):
+        return data.get("result")
+    if not isinstance(data, dict):
+        raise TelegramAPIError(method, status, "响应不是 JSON")
+    params = data.get("parameters") or {}
+    raise TelegramAPIError(
+        method,
+        int(data.get("error_code") or status),
+        str(data.get("description", "")),
+        params.get("retry_after"),
+    )
+
+
+def call(method: str, payload: dict[str, Any], token: str | None = None, timeout: float | None = None) -> Any:
+    """同步调用 Bot API，返回 result 字段；失败抛 TelegramAPIError 或网络异常"""
+    r = _get_session().post(
+        _url(method, token),
+        json=payload,
+        timeout=(CONNECT_TIMEOUT, timeout or READ_TIMEOUT),
+    )
+    try:
+        data = r.json()
+    except ValueError:
+        r.raise_for_status()
+        data = None
+    return _unwrap(method, r.status_code, data)
+
+
+def send_message(
+    chat_id: str | int,
+    text: str,
+    parse_mode: str | None = "Markdown",
+    reply_markup: dict | None = None,
+    token: str | None = None,
+) -> dict:
+    """发送消息，返回 Message 对象（含 message_id）"""
+    payload: dict[str, Any] = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    return call("sendMessage", payload, token=token)
+
+
+def edit_message_text(
+    chat_id: str | int,
+    message_id: int,
+    text: str,
+    parse_mode: str | None = "Markdown",
+    reply_markup: dict | None = None,
+    token: str | None = None,
+) -> Any:
+    """编辑已发送的消息"""
+    payload: dict[str, Any] = {"chat_id": chat_id, "message_id": message_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    return call("editMessageText", payload, token=token)
+
+
+# ============ 异步版本 ============
+def _get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(id(loop))
+    if client is None or client.is_closed:
+        import httpx
+
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+        )
+        _async_clients[id(loop)] = client
+    return client
+
+
+async def call_async(method: str, payload: dict[str, Any], token: str | None = None, timeout: float | None = None) -> Any:
+    """异步调用 Bot API，语义同 call"""
+    r = await _get_async_client().post(_url(method, token), json=payload, timeout=timeout or READ_TIMEOUT)
+    try:
+        data = r.json()
+    except ValueError:
+        r.raise_for_status()
+        data = None
+    return _unwrap(method, r.status_code, data)
+
+
+async def send_message_async(
+    chat_id: str | int,
+    text: str,
+    parse_mode: str | None = "Markdown",
+    reply_markup: dict | None = None,
+    token: str | None = None,
+) -> dict:
+    payload: dict[str, Any] = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    return await call_async("sendMessage", payload, token=token)
+
+
+async def aclose() -> None:
+    """关闭当前事件循环的异步连接池"""
+    client = _async_clients.pop(id(asyncio.get_running_loop()), None)
+    if client is not None:
+        await client.aclose()
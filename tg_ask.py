@@ -1,11 +1,11 @@
 import sys
 import os
-import time
-import uuid
-import requests
 from dotenv import load_dotenv
 
-def ask_permission(question):
+import approvals
+import telegram_client
+
+def ask_permission(question, timeout_sec=3600):
     load_dotenv()
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     allowed_users = os.getenv("ALLOWED_USER_IDS", "")
@@ -15,9 +15,8 @@ def ask_permission(question):
         sys.exit(1)
         
     main_user_id = allowed_users.split(",")[0].strip()
-    req_id = str(uuid.uuid4())[:8]
+    req_id = approvals.create(timeout_sec)
     
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
     keyboard = {
         "inline_keyboard": [[
             {"text": "✅ 允许执行", "callback_data": f"approve_{req_id}"},
@@ -25,43 +24,22 @@ def ask_permission(question):
         ]]
     }
     
-    payload = {
-        "chat_id": main_user_id,
-        "text": f"⚠️ **【请求权限】**\n\n{question}",
-        "parse_mode": "Markdown",
-        "reply_markup": keyboard
-    }
-    
     try:
-        req = requests.post(url, json=payload)
-        req.raise_for_status()
+        telegram_client.send_message(main_user_id, f"⚠️ **【请求权限】**\n\n{question}", reply_markup=keyboard, token=token)
         print(f"[{req_id}] 权限请求已发送给管理员，等待回复中...")
     except Exception as e:
         print(f"发送请求失败: {e}")
+        approvals.cancel(req_id)
         sys.exit(1)
         
-    signal_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), f".tg_response_{req_id}.txt")
-    
-    # 阻塞轮询等待文件出现
-    while True:
-        if os.path.exists(signal_file):
-            with open(signal_file, "r", encoding="utf-8") as f:
-                verdict = f.read().strip()
-            
-            # 清理临时文件
-            try:
-                os.remove(signal_file)
-            except:
-                pass
-                
-            if verdict == "APPROVED":
-                print("\n[SUCCESS] 用户已批准操作。继续执行。")
-                sys.exit(0)
-            else:
-                print("\n[REJECTED] 用户拒绝了操作。安全回退。")
-                sys.exit(1)
-                
-        time.sleep(1)
+    # 由 Bot 进程直接回写结果并唤醒，无需轮询
+    approved = approvals.wait(req_id, timeout_sec)
+    if approved:
+        print("\n[SUCCESS] 用户已批准操作。继续执行。")
+        sys.exit(0)
+    else:
+        print("\n[REJECTED] 用户拒绝了操作或请求超时。安全回退。")
+        sys.exit(1)
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -1,8 +1,9 @@
 import sys
 import os
-import requests
 from dotenv import load_dotenv
 
+import telegram_client
+
 def send_message(message):
     load_dotenv()
     token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -15,16 +16,8 @@ def send_message(message):
     # Get the first allowed user as the primary admin
     main_user_id = allowed_users.split(",")[0].strip()
     
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    payload = {
-        "chat_id": main_user_id,
-        "text": f"🤖 **【Agent 汇报】**\n\n{message}",
-        "parse_mode": "Markdown"
-    }
-    
     try:
-        req = requests.post(url, json=payload)
-        req.raise_for_status()
+        telegram_client.send_message(main_user_id, f"🤖 **【Agent 汇报】**\n\n{message}", token=token)
         print("Message sent successfully.")
     except Exception as e:
         print(f"Failed to send message: {e}")
@@ -3,9 +3,13 @@
 agent_cursor: 执行系统命令
 agent_filesystem: 文件读写、目录列表、搜索
 """
-import subprocess
 import os
-import glob as glob_module
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
 
 # 默认沙箱目录，由 mcp_agent 设置
 _approved_base = os.path.expanduser("~")
@@ -26,24 +30,93 @@ def _resolve_path(path: str) -> str:
     return abs_path
 
 
+# ============ 只读工具结果缓存 ============
+# 同一任务里反复读同一文件、搜索同一目录时直接返回缓存（list_dir 含各条目的大小和时间，不缓存）。
+# 单个文件按 (mtime, size) 校验；递归的 glob/grep 另受 TTL 和写入代数约束，
+# write_file、run_command 之后代数加一，递归结果全部作废。
+CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", "256"))
+CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", "30"))
+
+_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_generation = 0
+
+
+def _stat_sig(path: str) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _cache_get(key: tuple, sig: tuple | None, recursive: bool = False) -> str | None:
+    if CACHE_SIZE <= 0 or sig is None:
+        return None
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            value, entry_sig, generation, expires = entry
+            if entry_sig == sig and (not recursive or (generation == _generation and time.monotonic() < expires)):
+                _cache.move_to_end(key)
+                _cache_stats["hits"] += 1
+                return value
+            del _cache[key]
+        _cache_stats["misses"] += 1
+        return None
+
+
+def _cache_put(key: tuple, sig: tuple | None, value: str) -> None:
+    if CACHE_SIZE <= 0 or sig is None:
+        return
+    with _cache_lock:
+        _cache[key] = (value, sig, _generation, time.monotonic() + CACHE_TTL)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def invalidate_cache(path: str | None = None) -> None:
+    """文件系统可能已改变：递归结果全部作废；给定 path 时同时删除该路径的缓存"""
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        _cache_stats["invalidations"] += 1
+        if path is not None:
+            for key in [k for k in _cache if k[1] == path]:
+                del _cache[key]
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def cache_stats() -> dict[str, int]:
+    """缓存命中统计：hits / misses / invalidations / size"""
+    with _cache_lock:
+        return {**_cache_stats, "size": len(_cache)}
+
+
 # ============ agent_cursor：命令执行 ============
-def run_command(command: str) -> str:
-    """运行终端命令并返回其输出结果。用于执行脚本、测试、git、安装依赖等。"""
+def run_command(command: str, timeout: int | None = None, task_id: str = "") -> str:
+    """运行终端命令并返回其输出结果。用于执行脚本、测试、git、安装依赖等。timeout 为超时秒数（默认 60）。"""
+    import command_runner
+
+    # 命令可能改动任意文件，先让递归缓存失效
+    invalidate_cache()
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            text=True,
-            capture_output=True,
-            timeout=60,
-            cwd=_approved_base,
-        )
-        output = result.stdout
-        if result.stderr:
-            output += f"\nStderr: {result.stderr}"
-        return output[:6000] if output else "(无输出)"
-    except subprocess.TimeoutExpired:
-        return "命令执行超时（60秒）"
+        run = command_runner.run(command, _approved_base, timeout=timeout, task_id=task_id)
+        invalidate_cache()
+        output = run.output()
+        if run.timed_out:
+            return f"{output}\n命令执行超时（{run.timeout:g}秒），已终止".lstrip()
+        if run.cancelled:
+            return f"{output}\n命令已取消".lstrip()
+        if run.returncode:
+            output += f"\n退出码: {run.returncode}"
+        return output if output else "(无输出)"
     except Exception as e:
         return f"执行命令时出现异常: {str(e)}"
 
@@ -53,8 +126,74 @@ def read_file(path: str, limit: int = 8000) -> str:
     """读取文件内容。支持文本文件。"""
     try:
         safe_path = _resolve_path(path)
+        key = ("read_file", safe_path, limit)
+        sig = _stat_sig(safe_path)
+        cached = _cache_get(key, sig)
+        if cached is not None:
+            return cached
         with open(safe_path, "r", encoding="utf-8", errors="replace") as f:
-            return f.read(limit)
+            text = f.read(limit)
+        _cache_put(key, sig, text)
+        return text
+    except PermissionError as e:
+        return str(e)
+    except Exception as e:
+        return f"读取文件 {path} 时出错: {str(e)}"
+
+
+def read_file_range(
+    path: str,
+    start_line: int = 0,
+    end_line: int = 0,
+    offset: int | None = None,
+    length: int = 0,
+    limit: int = 8000,
+) -> str:
+    """
+    分段读取大文件，不必从头读起。两种方式二选一：
+    按行：start_line（从 1 开始，负数表示倒数第几行）到 end_line（含，默认到 limit 字符为止）
+    按字节：offset（负数表示从文件末尾倒数）起读 length 字节（默认 limit）
+    """
+    import mmap
+    import line_index
+
+    try:
+        safe_path = _resolve_path(path)
+        with open(safe_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            if size == 0:
+                return f"[{path} 为空文件]"
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if not start_line and offset is not None:
+                    start = offset if offset >= 0 else max(size + offset, 0)
+                    end = min(start + (length or limit), size)
+                    text = mm[start:end].decode("utf-8", errors="replace")
+                    return f"[{path} 字节 {start}-{end} / 共 {size} 字节]\n{text}"
+
+                index = line_index.get(safe_path, st)
+                with index.lock:
+                    total = None
+                    first = (start_line or 1) - 1
+                    if first < 0:
+                        total = index.total_lines(mm)
+                        first = max(total + first + 1, 0)
+                    start = index.line_offset(mm, first)
+                    if start is None:
+                        total = index.total_lines(mm)
+                        return f"[{path} 共 {total} 行，第 {first + 1} 行超出范围]"
+                    if end_line and end_line > first:
+                        end = index.line_offset(mm, end_line)
+                        end = size if end is None else end
+                    else:
+                        end = size
+                    if index.complete:
+                        total = index.scanned_lines
+                end = min(end, start + limit * 4)
+                text = mm[start:end].decode("utf-8", errors="replace")[:limit]
+                last = first + text.count("\n") + (0 if text.endswith("\n") else 1)
+                total_s = f" / 共 {total} 行" if total is not None else ""
+                return f"[{path} 第 {first + 1}-{last} 行{total_s}，字节 {start}-{start + len(text.encode('utf-8'))}]\n{text}"
     except PermissionError as e:
         return str(e)
     except Exception as e:
@@ -68,6 +207,7 @@ def write_file(path: str, content: str) -> str:
         os.makedirs(os.path.dirname(safe_path) or ".", exist_ok=True)
         with open(safe_path, "w", encoding="utf-8") as f:
             f.write(content)
+        invalidate_cache(safe_path)
         return f"成功写入文件 {path}"
     except PermissionError as e:
         return str(e)
@@ -75,69 +215,347 @@ def write_file(path: str, content: str) -> str:
         return f"写入文件 {path} 时出错: {str(e)}"
 
 
-def list_dir(path: str = ".") -> str:
-    """列出目录下的文件和子目录。类似 ls 命令。"""
+# ============ 局部编辑：只传改动部分 ============
+def _current_umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_UMASK = _current_umask()
+
+
+def _stage(safe_path: str, content: str, mode_from: str | None = None) -> str:
+    """
+    在目标目录写好临时文件并返回其路径（尚未替换目标）
+    权限取自 mode_from（默认目标本身）；都不存在时按 umask 给普通文件权限，而不是 mkstemp 的 0600
+    """
+    import tempfile
+
+    directory = os.path.dirname(safe_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+        try:
+            mode = os.stat(mode_from or safe_path).st_mode & 0o7777
+        except OSError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp, mode)
+    except BaseException:
+        _discard(tmp)
+        raise
+    return tmp
+
+
+def _discard(tmp: str) -> None:
+    try:
+        os.unlink(tmp)
+    except OSError:
+        pass
+
+
+def _check_sig(safe_path: str, expected_sig: tuple | None) -> None:
+    """expected_sig 为读取时的 (mtime, size)；None 表示文件必须不存在"""
+    current = _stat_sig(safe_path)
+    if current == expected_sig:
+        return
+    if expected_sig is None:
+        raise RuntimeError(f"{safe_path} 已存在")
+    raise RuntimeError("文件在编辑期间被修改，请重新读取后再试")
+
+
+def _atomic_write(safe_path: str, content: str, expected_sig: tuple | None) -> None:
+    """
+    写临时文件再 os.replace，读者只会看到旧内容或新内容
+    写入前文件的 (mtime, size) 与 expected_sig 不符（被别人改过）则抛 RuntimeError
+    """
+    tmp = _stage(safe_path, content)
+    try:
+        _check_sig(safe_path, expected_sig)
+        os.replace(tmp, safe_path)
+    except BaseException:
+        _discard(tmp)
+        raise
+    invalidate_cache(safe_path)
+
+
+def _read_for_edit(safe_path: str) -> tuple[str, tuple | None]:
+    sig = _stat_sig(safe_path)
+    with open(safe_path, "r", encoding="utf-8", newline="") as f:
+        return f.read(), sig
+
+
+def edit_file(path: str, old_string: str, new_string: str, replace_all: bool = False) -> str:
+    """
+    局部修改文件：把 old_string 替换为 new_string（只需传改动附近的片段）。
+    old_string 必须在文件中唯一出现（replace_all=True 时替换全部）；新建文件请用 write_file。
+    """
+    try:
+        safe_path = _resolve_path(path)
+        if not old_string:
+            return "old_string 不能为空"
+        text, sig = _read_for_edit(safe_path)
+        if old_string not in text and "\r\n" in text:
+            # 模型给的片段通常是 \n 换行，按文件的换行风格再试一次
+            old_string = old_string.replace("\r\n", "\n").replace("\n", "\r\n")
+            new_string = new_string.replace("\r\n", "\n").replace("\n", "\r\n")
+        count = text.count(old_string)
+        if count == 0:
+            return f"编辑失败：{path} 中未找到 old_string，请先读取文件确认当前内容"
+        if count > 1 and not replace_all:
+            return f"编辑失败：old_string 在 {path} 中出现 {count} 次，请包含更多上下文使其唯一，或设置 replace_all"
+        new_text = text.replace(old_string, new_string) if replace_all else text.replace(old_string, new_string, 1)
+        _atomic_write(safe_path, new_text, sig)
+        return f"成功编辑文件 {path}（替换 {count if replace_all else 1} 处）"
+    except PermissionError as e:
+        return str(e)
+    except Exception as e:
+        return f"编辑文件 {path} 时出错: {str(e)}"
+
+
+def _patch_path(rel: str) -> str:
+    return _resolve_path(rel if os.path.isabs(rel) else os.path.join(_approved_base, rel))
+
+
+def apply_patch(patch: str) -> str:
+    """
+    应用 unified diff 补丁（可含多个文件，支持新建、删除和改名）。
+    路径相对于沙箱目录；先核对所有 hunk 并写好全部临时文件，都没问题才逐个替换，
+    替换中途出错会把已改的文件恢复原状。
+    """
+    import unified_diff
+
+    try:
+        file_patches = unified_diff.parse(patch)
+        # (源路径, 源文件读取时的 sig, 源文件原内容, 目标路径, 新内容, fp)；删除时目标为 None
+        planned = []
+        seen: set[str] = set()
+        for fp in file_patches:
+            source = _patch_path(fp.old_path) if fp.old_path else None
+            target = _patch_path(fp.new_path) if fp.new_path else None
+            for p in {source, target} - {None}:
+                if p in seen:
+                    raise unified_diff.PatchConflict(f"{p} 在补丁中出现多次")
+                seen.add(p)
+            if source is None:
+                text, sig = "", None
+            else:
+                text, sig = _read_for_edit(source)
+            new_text = unified_diff.apply(text, fp)
+            if target is None and new_text:
+                raise unified_diff.PatchConflict(f"{fp.old_path} 的删除补丁与文件内容不一致，拒绝删除")
+            if target is not None and target != source and os.path.exists(target):
+                raise unified_diff.PatchConflict(f"{fp.new_path} 已存在，不能{'作为新文件创建' if source is None else '作为改名目标'}")
+            planned.append((source, sig, text, target, new_text, fp))
+
+        staged: dict[str, str] = {}
+        try:
+            for source, _, _, target, new_text, _ in planned:
+                if target is not None:
+                    staged[target] = _stage(target, new_text, mode_from=source)
+            for source, sig, _, target, _, _ in planned:
+                if source is not None:
+                    _check_sig(source, sig)
+                if target is not None and target != source:
+                    _check_sig(target, None)
+            _commit_patch(planned, staged)
+        finally:
+            for tmp in staged.values():
+                _discard(tmp)
+
+        summary = []
+        for source, _, _, target, _, fp in planned:
+            added = sum(len(h.new) - len(h.old) for h in fp.hunks)
+            if target is None:
+                summary.append(f"删除 {fp.old_path}")
+                continue
+            if source is None:
+                action = "新建"
+            elif target != source:
+                action = f"改名 {fp.old_path} →"
+            else:
+                action = "修改"
+            summary.append(f"{action} {fp.path}（{len(fp.hunks)} 个 hunk，行数 {added:+d}）")
+        return "成功应用补丁:\n" + "\n".join(summary)
+    except (unified_diff.PatchConflict, RuntimeError) as e:
+        return f"补丁冲突，未修改任何文件: {e}"
+    except PermissionError as e:
+        return str(e)
+    except Exception as e:
+        return f"应用补丁时出错: {str(e)}"
+
+
+def _commit_patch(planned: list, staged: dict[str, str]) -> None:
+    """逐个替换/删除；任何一步失败，把已完成的步骤按原内容撤销后再抛出"""
+    undo: list[tuple[str, str | None]] = []  # (路径, 原内容)；None 表示原本不存在
+    try:
+        for source, _, text, target, _, _ in planned:
+            if target is not None:
+                os.replace(staged[target], target)
+                del staged[target]
+                undo.append((target, text if target == source else None))
+                invalidate_cache(target)
+            if source is not None and source != target:
+                os.remove(source)
+                undo.append((source, text))
+                invalidate_cache(source)
+    except BaseException:
+        for path, original in reversed(undo):
+            try:
+                if original is None:
+                    os.remove(path)
+                else:
+                    with open(path, "w", encoding="utf-8", newline="") as f:
+                        f.write(original)
+                invalidate_cache(path)
+            except OSError as e:
+                logger.error(f"补丁回滚失败 {path}: {e}")
+        raise
+
+
+def _human_size(n: int) -> str:
+    size = float(n)
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{n}B" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def _page_footer(shown: int, offset: int, more: bool, total: int | None = None) -> str:
+    if not more:
+        return ""
+    total_s = f"共 {total} 项，" if total is not None else ""
+    return f"\n…（{total_s}已显示 {offset + 1}-{offset + shown}，下一页 offset={offset + shown}）"
+
+
+def list_dir(path: str = ".", offset: int = 0, limit: int = 100) -> str:
+    """列出目录下的文件和子目录（含大小、修改时间）。类似 ls 命令。条目多时用 offset 翻页。"""
     try:
         safe_path = _resolve_path(path)
-        items = sorted(os.listdir(safe_path))
+        # 不缓存：条目的大小/修改时间变化不会改变目录自身的 (mtime, size)
+        with os.scandir(safe_path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        page = entries[offset:offset + limit]
         lines = []
-        for name in items[:100]:  # 最多 100 项
-            full = os.path.join(safe_path, name)
-            prefix = "[DIR] " if os.path.isdir(full) else ""
-            lines.append(f"{prefix}{name}")
-        return "\n".join(lines) if lines else "(空目录)"
+        for entry in page:
+            # DirEntry 自带类型，stat 结果也缓存在 entry 上，不再额外 isdir/stat
+            try:
+                if entry.is_dir():
+                    lines.append(f"[DIR] {entry.name}")
+                    continue
+                st = entry.stat()
+                mtime = time.strftime("%Y-%m-%d %H:%M", time.localtime(st.st_mtime))
+                lines.append(f"{entry.name}  {_human_size(st.st_size)}  {mtime}")
+            except OSError:
+                lines.append(entry.name)
+        result = "\n".join(lines) if lines else "(空目录)"
+        result += _page_footer(len(page), offset, offset + len(page) < len(entries), len(entries))
+        return result
     except PermissionError as e:
         return str(e)
     except Exception as e:
         return f"列出目录 {path} 时出错: {str(e)}"
 
 
-def glob_search(pattern: str, base_dir: str = ".") -> str:
-    """按通配符模式搜索文件。例如 *.py 或 **/*.md（** 表示递归）"""
+def glob_search(pattern: str, base_dir: str = ".", offset: int = 0, limit: int = 50) -> str:
+    """按通配符模式搜索文件。例如 *.py 或 **/*.md（** 表示递归）。结果多时用 offset 翻页。"""
     try:
+        import grep_engine
+
         safe_base = _resolve_path(base_dir)
-        full_pattern = os.path.join(safe_base, pattern)
-        matches = glob_module.glob(full_pattern, recursive=True)
-        # 转为相对路径便于阅读
-        rel = [os.path.relpath(m, safe_base) for m in matches[:50]]
-        return "\n".join(rel) if rel else f"未找到匹配: {pattern}"
+        key = ("glob_search", safe_base, pattern, offset, limit)
+        sig = _stat_sig(safe_base)
+        cached = _cache_get(key, sig, recursive=True)
+        if cached is not None:
+            return cached
+        # 没有通配符的前导目录直接拼到起点上；没有 ** 时只遍历到模式的层数
+        parts = pattern.replace("\\", "/").strip("/").split("/")
+        prefix = []
+        while len(parts) > 1 and not any(c in parts[0] for c in "*?["):
+            prefix.append(parts.pop(0))
+        start = os.path.join(safe_base, *prefix)
+        max_depth = None if any("**" in p for p in parts) else len(parts) - 1
+        regex = grep_engine.compile_glob("/".join(parts))
+
+        rel: list[str] = []
+        more = False
+        skipped = 0
+        if os.path.isdir(start):
+            for entry in grep_engine.iter_entries(start, max_depth=max_depth):
+                sub = os.path.relpath(entry.path, start).replace(os.sep, "/")
+                if not regex.match(sub):
+                    continue
+                if skipped < offset:
+                    skipped += 1
+                    continue
+                if len(rel) >= limit:
+                    more = True  # 多取一个只为知道还有下一页，随即停止遍历
+                    break
+                rel.append(os.path.relpath(entry.path, safe_base))
+        result = "\n".join(rel) if rel else f"未找到匹配: {pattern}"
+        result += _page_footer(len(rel), offset, more)
+        _cache_put(key, sig, result)
+        return result
     except PermissionError as e:
         return str(e)
     except Exception as e:
         return f"搜索 {pattern} 时出错: {str(e)}"
 
 
+def _index_candidates(safe_path: str, pattern: str) -> list[str] | None:
+    """
+    SEARCH_INDEX=1 时用三元组索引缩小到候选文件；不可用时返回 None（全量扫描）
+    索引从沙箱根目录遍历，不含被跳过/忽略的目录；显式搜索这些目录时同样返回 None
+    """
+    import grep_engine
+    import search_index
+
+    if not search_index.INDEX_ENABLED:
+        return None
+    if grep_engine.is_pruned(_approved_base, safe_path):
+        return None
+    try:
+        paths = search_index.candidates(_approved_base, pattern, _generation, subtree=safe_path)
+    except Exception as e:
+        logger.warning(f"搜索索引不可用，改为全量扫描: {e}")
+        return None
+    if paths is None:
+        return None
+    prefix = safe_path.rstrip(os.sep) + os.sep
+    return [p for p in paths if p.startswith(prefix)]
+
+
 def grep_search(pattern: str, path: str, max_results: int = 20) -> str:
     """在文件或目录中搜索包含指定文本的行。path 可以是文件或目录。"""
     try:
-        import re
-        safe_path = _resolve_path(path)
-        results = []
-        regex = re.compile(pattern, re.IGNORECASE)
+        import grep_engine
 
-        def search_in_file(fp: str) -> None:
-            try:
-                with open(fp, "r", encoding="utf-8", errors="replace") as f:
-                    for i, line in enumerate(f, 1):
-                        if regex.search(line):
-                            results.append(f"{fp}:{i}: {line.rstrip()}")
-                            if len(results) >= max_results:
-                                return
-            except Exception:
-                pass
+        safe_path = _resolve_path(path)
+        key = ("grep_search", safe_path, pattern, max_results)
+        sig = _stat_sig(safe_path)
+        recursive = os.path.isdir(safe_path)
+        cached = _cache_get(key, sig, recursive=recursive)
+        if cached is not None:
+            return cached
+        regex = grep_engine.compile_pattern(pattern)
 
         if os.path.isfile(safe_path):
-            search_in_file(safe_path)
+            hits = grep_engine.search(regex, [safe_path], max_results, skip_binary=False)
         elif os.path.isdir(safe_path):
-            for root, _, files in os.walk(safe_path):
-                for f in files:
-                    if len(results) >= max_results:
-                        break
-                    search_in_file(os.path.join(root, f))
+            files = _index_candidates(safe_path, pattern)
+            if files is None:
+                files = (entry.path for entry in grep_engine.iter_files(safe_path))
+            hits = grep_engine.search(regex, files, max_results)
         else:
             return f"路径不存在: {path}"
 
-        return "\n".join(results) if results else f"未找到匹配: {pattern}"
+        results = [f"{fp}:{i}: {line}" for fp, i, line in hits]
+        result = "\n".join(results) if results else f"未找到匹配: {pattern}"
+        _cache_put(key, sig, result)
+        return result
     except PermissionError as e:
         return str(e)
     except Exception as e:
@@ -0,0 +1,144 @@
+"""
+unified diff 解析与应用（apply_patch 工具用）
+
+- 支持多文件、新建（--- /dev/null）、删除（+++ /dev/null）、"\\ No newline at end of file"
+- 每个 hunk 先在标注的行号处匹配上下文和删除行，不符时在附近上下搜索（行号可以不准）
+- 任何一个 hunk 对不上就抛 PatchConflict，调用方一个文件都不写
+"""
+import re
+
+_HUNK = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+# hunk 在标注位置对不上时，上下最多搜索多少行
+FUZZ_LINES = 2000
+
+
+class PatchConflict(Exception):
+    """补丁与文件当前内容不一致"""
+
+
+class Hunk:
+    def __init__(self, old_start: int):
+        self.old_start = old_start
+        self.old: list[str] = []  # 上下文 + 删除行
+        self.new: list[str] = []  # 上下文 + 新增行
+        self.old_no_eol = False
+        self.new_no_eol = False
+
+
+class FilePatch:
+    def __init__(self, old_path: str | None, new_path: str | None):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks: list[Hunk] = []
+
+    @property
+    def path(self) -> str:
+        return self.new_path or self.old_path or ""
+
+
+def _strip_prefix(name: str) -> str | None:
+    name = name.split("\t", 1)[0].strip()
+    if name == "/dev/null":
+        return None
+    if name.startswith(("a/", "b/")):
+        name = name[2:]
+    return name
+
+
+def parse(patch: str) -> list[FilePatch]:
+    files: list[FilePatch] = []
+    lines = patch.replace("\r\n", "\n").split("\n")
+    i = 0
+    current: FilePatch | None = None
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ "):
+            current = FilePatch(_strip_prefix(line[4:]), _strip_prefix(lines[i + 1][4:]))
+            files.append(current)
+            i += 2
+            continue
+        m = _HUNK.match(line)
+        if m and current is not None:
+            hunk = Hunk(int(m.group(1)))
+            old_left = int(m.group(2)) if m.group(2) is not None else 1
+            new_left = int(m.group(4)) if m.group(4) is not None else 1
+            i += 1
+            last = ""
+            while i < len(lines) and (old_left > 0 or new_left > 0 or lines[i].startswith("\\")):
+                body = lines[i]
+                if _HUNK.match(body) or (body.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ ")):
+                    break  # 头部计数偏大时，遇到下一个 hunk / 文件头即结束
+                tag, text = (body[:1], body[1:]) if body else (" ", "")
+                if tag == " ":
+                    hunk.old.append(text)
+                    hunk.new.append(text)
+                    old_left -= 1
+                    new_left -= 1
+                elif tag == "-":
+                    hunk.old.append(text)
+                    old_left -= 1
+                elif tag == "+":
+                    hunk.new.append(text)
+                    new_left -= 1
+                elif tag == "\\":
+                    if last in (" ", "-"):
+                        hunk.old_no_eol = True
+                    if last in (" ", "+"):
+                        hunk.new_no_eol = True
+                else:
+                    break
+                last = tag
+                i += 1
+            current.hunks.append(hunk)
+            continue
+        i += 1
+    if not files:
+        raise PatchConflict("补丁中没有找到文件头（--- / +++）")
+    return files
+
+
+def _find(lines: list[str], needle: list[str], hint: int, floor: int) -> int:
+    """在 lines[floor:] 中找 needle，优先离 hint 最近的位置；找不到返回 -1"""
+    n = len(needle)
+    if n == 0:
+        return max(min(hint, len(lines)), floor)
+    for delta in range(FUZZ_LINES + 1):
+        for pos in ((hint - delta, hint + delta) if delta else (hint,)):
+            if floor <= pos <= len(lines) - n and lines[pos:pos + n] == needle:
+                return pos
+    return -1
+
+
+def _split_lines(text: str) -> list[str]:
+    """按 \n / \r\n 拆行（不像 splitlines 那样把 \f 等字符也当换行）"""
+    if not text:
+        return []
+    lines = text.split("\n")
+    if text.endswith("\n"):
+        lines.pop()
+    return [line[:-1] if line.endswith("\r") else line for line in lines]
+
+
+def apply(text: str, fp: FilePatch) -> str:
+    """把一个文件的所有 hunk 应用到 text 上，返回新内容；对不上抛 PatchConflict"""
+    eol = "\r\n" if "\r\n" in text else "\n"
+    ends_with_eol = text.endswith("\n")
+    lines = _split_lines(text)
+    out: list[str] = []
+    cursor = 0
+    for n, hunk in enumerate(fp.hunks, 1):
+        hint = max(hunk.old_start - 1, 0) if hunk.old else hunk.old_start
+        pos = _find(lines, hunk.old, hint, cursor)
+        if pos < 0:
+            preview = "\n".join(hunk.old[:3])
+            raise PatchConflict(f"{fp.path} 第 {n} 个 hunk 对不上当前内容（约第 {hunk.old_start} 行）:\n{preview}")
+        out.extend(lines[cursor:pos])
+        out.extend(hunk.new)
+        cursor = pos + len(hunk.old)
+        if cursor >= len(lines):
+            # 改到了文件末尾（含只追加行的 hunk）：末行是否带换行以补丁为准
+            ends_with_eol = not hunk.new_no_eol
+    out.extend(lines[cursor:])
+    if not out:
+        return ""
+    return eol.join(out) + (eol if ends_with_eol else "")